@@ -0,0 +1,500 @@
+"""
+Watermark engine micro-benchmarks.
+
+    python bench.py             # saare benchmarks
+    python bench.py diagonal    # sirf ek benchmark
+
+Bench DB ya Telegram touch nahi karta; BOT_TOKEN / MONGODB_URL set na hon
+to dummy values use hoti hain taaki bot.py import ho sake.
+"""
+import os
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+from io import BytesIO
+
+os.environ.setdefault("BOT_TOKEN", "0:bench")
+os.environ.setdefault("MONGODB_URL", "mongodb://localhost:27017")
+
+from PIL import Image, ImageChops  # noqa: E402
+
+import bot  # noqa: E402
+
+RESOLUTIONS = [(640, 480), (1280, 960), (2560, 1920), (4000, 3000)]
+
+
+def synth_image(w: int, h: int) -> Image.Image:
+    return Image.linear_gradient("L").resize((w, h)).convert("RGB")
+
+
+def synth_photo(w: int, h: int) -> Image.Image:
+    # noise ke saath JPEG size asli photos jaisa (MBs) aata hai
+    noise = Image.effect_noise((w, h), 48)
+    return Image.merge("RGB", (noise, Image.linear_gradient("L").resize((w, h)), noise))
+
+
+def synth_jpeg(w: int, h: int, quality: int = 92, photo: bool = False) -> bytes:
+    out = BytesIO()
+    (synth_photo(w, h) if photo else synth_image(w, h)).save(out, "JPEG", quality=quality)
+    return out.getvalue()
+
+
+def best_ms(fn, repeat: int = 5) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        t = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t)
+    return best * 1000
+
+# ------------------------------------------------------------
+# DIAGONAL: full-frame rotate vs stamp-only rotate
+# ------------------------------------------------------------
+def _diag_full_frame(img, stamp, x, y, angle):
+    # purana tareeka: full-size canvas, poora rotate(expand=True), phir crop
+    W, H = img.size
+    temp = Image.new("RGBA", img.size, (0, 0, 0, 0))
+    temp.paste(stamp, (x, y))
+    rot = temp.rotate(angle, expand=True)
+    rw, rh = rot.size
+    left = max(0, (rw - W) // 2)
+    top = max(0, (rh - H) // 2)
+    cropped = rot.crop((left, top, left + W, top + H))
+    ink = cropped.getchannel("A").getbbox()
+    if ink:
+        bot.blend_stamp(img, cropped.crop(ink), ink[0], ink[1])
+
+
+def _diag_stamp_only(img, args, x, y, angle):
+    stamp, _ = bot.get_stamp(*args)
+    rot, rx, ry = bot.diag_stamp(args, stamp, x, y, *img.size, angle)
+    bot.blend_stamp(img, rot, rx, ry)
+
+
+def bench_diagonal():
+    print("diag_tl_br watermark layer (ms, best of 5), max diff vs full-frame")
+    print(
+        f"{'resolution':>12} {'full-frame':>11} {'stamp cold':>11} {'stamp warm':>11} "
+        f"{'speedup':>8} {'max diff':>9}"
+    )
+    for w, h in RESOLUTIONS:
+        font_size = max(10, max(20, w // 20))
+        args = (bot.DEFAULT_WATERMARK, "sans_default", font_size, (255, 255, 255), 220, "normal")
+        stamp, bbox = bot.get_stamp(*args)
+        x = (w - (bbox[2] - bbox[0])) // 2 + bbox[0]
+        y = (h - (bbox[3] - bbox[1])) // 2 + bbox[1]
+        base = synth_image(w, h)
+
+        ref, out = base.copy(), base.copy()
+        _diag_full_frame(ref, stamp, x, y, -35)
+        _diag_stamp_only(out, args, x, y, -35)
+        diff = max(hi for _, hi in ImageChops.difference(ref, out).getextrema())
+
+        full = best_ms(lambda: _diag_full_frame(base.copy(), stamp, x, y, -35))
+
+        def cold():
+            bot.STAMP_CACHE.clear()
+            _diag_stamp_only(base.copy(), args, x, y, -35)
+
+        cold_ms = best_ms(cold)
+        warm = best_ms(lambda: _diag_stamp_only(base.copy(), args, x, y, -35))
+        copy_ms = best_ms(lambda: base.copy())
+        full, cold_ms, warm = full - copy_ms, cold_ms - copy_ms, warm - copy_ms
+        print(
+            f"{f'{w}x{h}':>12} {full:>11.2f} {cold_ms:>11.2f} {warm:>11.2f} "
+            f"{full / max(warm, 1e-3):>7.1f}x {diff:>9}"
+        )
+
+# ------------------------------------------------------------
+# COPIES: download -> render -> upload byte copies, peak memory
+# ------------------------------------------------------------
+def _rss_kb(field: str) -> int:
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(field + ":"):
+                return int(line.split()[1])
+    raise RuntimeError(f"{field} /proc/self/status me nahi mila")
+
+
+def _copy_path(variant: str, w: int, h: int, measure: str):
+    import asyncio
+
+    from telegram import InputFile
+
+    raw = synth_jpeg(w, h, photo=True)
+
+    async def download(out):
+        # File.download_to_memory() jaisa: retrieve() ka naya bytes object out.write() me
+        buf = bytes(memoryview(raw))
+        out.write(buf)
+
+    # "trace": har stage ka Python buffer peak (tracemalloc).
+    # "rss": tracemalloc ke bina poore path ka RSS growth; tracemalloc ka apna
+    # overhead RSS me na aaye isliye alag process me chalta hai.
+    peaks = []
+    if measure == "trace":
+        tracemalloc.start()
+
+        def mark():
+            peaks.append(tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+    else:
+        # import + synth ke baad ka RSS baseline; VmHWM reset (clear_refs 5)
+        # taaki peak sirf is path ka ho, parent ka high-water mark nahi
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        base_kb = _rss_kb("VmRSS")
+
+        def mark():
+            pass
+
+    # download (photo_handler)
+    if variant == "legacy":
+        bio = BytesIO()
+        asyncio.run(download(bio))
+        img_bytes = bio.getvalue()
+        del bio
+    else:
+        sink = bot.DownloadSink()
+        asyncio.run(download(sink))
+        img_bytes = sink.getvalue()
+        del sink
+    mark()
+
+    # render
+    wm_bytes = bot.create_watermark(img_bytes, bot.DEFAULT_WATERMARK, bot.DEFAULT_SETTINGS)
+    mark()
+
+    # upload (text_handler -> reply_photo)
+    if variant == "legacy":
+        out = BytesIO(wm_bytes)
+        out.name = "watermarked.jpg"
+        upload = InputFile(out)
+    else:
+        upload = InputFile(wm_bytes, filename=bot.output_name(bot.DEFAULT_SETTINGS))
+    assert upload.input_file_content
+    mark()
+
+    if measure == "trace":
+        tracemalloc.stop()
+        print(len(raw), *peaks)
+    else:
+        print(_rss_kb("VmHWM") - base_kb)
+
+
+def _copy_run(*args) -> list:
+    res = subprocess.run(
+        [sys.executable, __file__, "_copy_path", *map(str, args)],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return [int(v) for v in res.stdout.splitlines()[-1].split()]
+
+
+def bench_copies():
+    print("download -> render -> upload, Python buffer peak per stage (MB) + peak RSS growth (MB),")
+    print("fresh process per run; RSS run tracemalloc ke bina, median of 5")
+    print(
+        f"{'resolution':>12} {'jpeg MB':>8} {'variant':>9} {'download':>9} "
+        f"{'render':>8} {'upload':>8} {'RSS +':>8}"
+    )
+    for w, h in RESOLUTIONS:
+        for variant in ("legacy", "zerocopy"):
+            size, dl, render, up = _copy_run(variant, w, h, "trace")
+            rss = sorted(_copy_run(variant, w, h, "rss")[0] for _ in range(5))[2]
+            mb = 2 ** 20
+            print(
+                f"{f'{w}x{h}':>12} {size / mb:>8.2f} {variant:>9} {dl / mb:>9.2f} "
+                f"{render / mb:>8.2f} {up / mb:>8.2f} {rss / 1024:>8.1f}"
+            )
+
+
+# ------------------------------------------------------------
+# BLEND: har render backend ka stamp region blend
+# ------------------------------------------------------------
+def bench_blend():
+    names = list(bot.RENDER_BACKENDS)
+    print(f"stamp region blend (ms, best of 20), max diff vs pillow; backends: {', '.join(names)}")
+    print(f"{'stamp':>12}" + "".join(f" {name:>8}" for name in names) + f" {'max diff':>9}")
+    for w, h in RESOLUTIONS:
+        font_size = max(20, w // 20)
+        stamp, _ = bot.get_stamp(bot.DEFAULT_WATERMARK, "sans_default", font_size, (255, 255, 255), 220, "normal")
+        base = synth_photo(stamp.width, stamp.height)
+        box = (0, 0, stamp.width, stamp.height)
+
+        ref = base.copy()
+        bot.blend_pillow(ref, stamp, box)
+        cols, diff = [], 0
+        copy_ms = best_ms(lambda: base.copy(), 20)
+        for name, blend in bot.RENDER_BACKENDS.items():
+            out = base.copy()
+            blend(out, stamp, box)
+            diff = max(diff, max(hi for _, hi in ImageChops.difference(ref, out).getextrema()))
+            cols.append(best_ms(lambda: blend(base.copy(), stamp, box), 20) - copy_ms)
+        size = f"{stamp.width}x{stamp.height}"
+        print(f"{size:>12}" + "".join(f" {ms:>8.3f}" for ms in cols) + f" {diff:>9}")
+
+
+# ------------------------------------------------------------
+# EFFECTS: text stamp rasterization (long texts)
+# ------------------------------------------------------------
+def _stamp_double_draw(text, font_key, font_size, color, alpha):
+    # purana tareeka: shadow aur fill ke liye do baar draw.text (do baar rasterize)
+    from PIL import ImageDraw
+
+    font = bot.load_font(font_key, font_size)
+    x0, y0, x1, y1 = font.getbbox(text)
+    off = bot.SHADOW_OFFSET
+    stamp = Image.new("RGBA", (x1 - x0 + off, y1 - y0 + off), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(stamp)
+    draw.text((off - x0, off - y0), text, font=font, fill=bot.SHADOW_FILL)
+    draw.text((-x0, -y0), text, font=font, fill=(*color, alpha))
+    return stamp
+
+
+def bench_effects():
+    print("text stamp build (ms, best of 10); 'recolour' = same text, naya colour (mask cached)")
+    print(
+        f"{'chars':>6} {'size':>5} {'double draw':>12} {'shadow':>8} {'recolour':>9} "
+        f"{'outline':>8} {'soft':>7}"
+    )
+    for chars in (20, 80, 200):
+        text = (bot.DEFAULT_WATERMARK + " ") * (chars // (len(bot.DEFAULT_WATERMARK) + 1) + 1)
+        text = text[:chars]
+        for size in (48, 120):
+            args = (text, "sans_default", size)
+            old = best_ms(lambda: _stamp_double_draw(*args, (255, 255, 255), 220), 10)
+
+            def cold(effect):
+                bot.STAMP_CACHE.clear()
+                bot.get_stamp(*args, (255, 255, 255), 220, "normal", effect)
+
+            shadow = best_ms(lambda: cold("shadow"), 10)
+
+            def recolour():
+                bot.STAMP_CACHE.clear()
+                bot.glyph_mask(text, "sans_default", size, "normal")
+                t = time.perf_counter()
+                bot.get_stamp(*args, (255, 0, 0), 220, "normal")
+                return time.perf_counter() - t
+
+            rec = min(recolour() for _ in range(10)) * 1000
+            outline = best_ms(lambda: cold("outline"), 10)
+            soft = best_ms(lambda: cold("soft"), 10)
+            print(
+                f"{chars:>6} {size:>5} {old:>12.2f} {shadow:>8.2f} {rec:>9.2f} "
+                f"{outline:>8.2f} {soft:>7.2f}"
+            )
+
+
+# ------------------------------------------------------------
+# GLYPHS: text mask via draw.text vs glyph atlas
+# ------------------------------------------------------------
+def _mask_draw_text(font, text):
+    from PIL import ImageDraw
+
+    x0, y0, x1, y1 = font.getbbox(text)
+    mask = Image.new("L", (x1 - x0, y1 - y0), 0)
+    ImageDraw.Draw(mask).text((-x0, -y0), text, font=font, fill=255)
+    return mask
+
+
+def bench_glyphs():
+    print("text mask build (ms, best of 20); atlas warm = saare glyphs + kern pairs pehle se atlas me")
+    print(f"{'chars':>6} {'size':>5} {'draw.text':>10} {'atlas warm':>11} {'speedup':>8} {'same':>5}")
+    for chars in (18, 80):
+        text = (bot.DEFAULT_WATERMARK + " ") * (chars // (len(bot.DEFAULT_WATERMARK) + 1) + 1)
+        text = text[:chars]
+        for size in (48, 120):
+            font = bot.load_font("sans_default", size)
+            old = best_ms(lambda: _mask_draw_text(font, text), 20)
+            bot.atlas_text_mask(font, text)
+            new = best_ms(lambda: bot.atlas_text_mask(font, text), 20)
+            same = _mask_draw_text(font, text).tobytes() == bot.atlas_text_mask(font, text)[0].tobytes()
+            print(f"{chars:>6} {size:>5} {old:>10.3f} {new:>11.3f} {old / new:>7.1f}x {str(same):>5}")
+
+
+# ------------------------------------------------------------
+# LAYOUT: BASIC vs RAQM per text (stamp cache cold, full render)
+# ------------------------------------------------------------
+LAYOUT_TEXTS = [bot.DEFAULT_WATERMARK, "@my_channel_2024 | t.me/share", "राजस्थान बोर्ड", "Café ☕ news"]
+
+
+def bench_layout():
+    print("1280x960 render, stamp cache cold (ms, best of 20); raqm = har text RAQM se (purana default)")
+    if not bot.HAVE_RAQM:
+        print("  (is Pillow build me libraqm nahi hai — sab text BASIC, raqm column = BASIC)")
+    print(f"{'text':>32} {'layout':>7} {'detect us':>10} {'raqm':>7} {'auto':>7} {'speedup':>8}")
+    raw = synth_jpeg(1280, 960)
+    detect = bot.text_layout
+
+    def render(text):
+        bot.STAMP_CACHE.clear()
+        bot.create_watermark(raw, text, bot.DEFAULT_SETTINGS)
+
+    for text in LAYOUT_TEXTS:
+        us = best_ms(lambda: [detect(text) for _ in range(100)], 10) * 10
+        auto = best_ms(lambda: render(text), 20)
+        bot.text_layout = lambda _text: bot.LAYOUT_DEFAULT
+        try:
+            raqm = best_ms(lambda: render(text), 20)
+        finally:
+            bot.text_layout = detect
+        name = "BASIC" if detect(text) == bot.ImageFont.Layout.BASIC else "RAQM"
+        print(f"{text:>32} {name:>7} {us:>10.2f} {raqm:>7.2f} {auto:>7.2f} {raqm / auto:>7.2f}x")
+
+
+# ------------------------------------------------------------
+# BUCKETS: font-size ladder granularity vs stamp cache hit rate
+# ------------------------------------------------------------
+BUCKET_STEPS = (0, 0.01, 0.02, 0.03, 0.05)
+SIZE_FACTORS = (0.7, 1.0, 1.4, 1.8)
+
+
+def synth_widths(n: int = 2000, seed: int = 7) -> list:
+    # Telegram photos: landscape 1280 / 2560 wide, portrait / documents ki width kuch bhi
+    rng = random.Random(seed)
+    return [
+        rng.choice((1280, 2560)) if rng.random() < 0.5 else rng.randint(400, 1280)
+        for _ in range(n)
+    ]
+
+
+def bench_buckets():
+    widths = synth_widths()
+    rng = random.Random(11)
+    factors = [rng.choice(SIZE_FACTORS) for _ in widths]
+    print(f"{len(widths)} photos, random width + size setting; stamp cache hit rate per ladder step")
+    print(f"{'step':>6} {'sizes':>6} {'hit rate':>9} {'worst err':>10} {'stamps ms':>10}")
+    get_stamp = bot.get_stamp
+    default_step = bot.FONT_SIZE_STEP
+    for step in BUCKET_STEPS:
+        bot.FONT_SIZE_STEP = step
+        bot.STAMP_CACHE.clear()
+        hits = 0
+
+        def counted(*args):
+            nonlocal hits
+            hits += bot.STAMP_CACHE.get(args) is not None
+            return get_stamp(*args)
+
+        bot.get_stamp = counted
+        sizes = set()
+        worst = 0.0
+        t = time.perf_counter()
+        try:
+            for w, f in zip(widths, factors):
+                settings = dict(bot.DEFAULT_SETTINGS, size_factor=f)
+                plan = bot.watermark_plan(bot.DEFAULT_WATERMARK, settings)
+                bot.watermark_layers(w, w * 3 // 4, plan)
+                exact = max(10, int(max(20, w // 20) * f))
+                got = bot.font_size_for(w, f)
+                sizes.add(got)
+                worst = max(worst, abs(got - exact) / exact)
+        finally:
+            bot.get_stamp = get_stamp
+        ms = (time.perf_counter() - t) * 1000
+        print(
+            f"{step:>6g} {len(sizes):>6} {hits / len(widths):>8.1%} "
+            f"{worst:>9.2%} {ms:>10.0f}"
+        )
+    bot.FONT_SIZE_STEP = default_step
+
+
+# ------------------------------------------------------------
+# AUTO: colour/position analysis overhead per render
+# ------------------------------------------------------------
+AUTO_BUDGET_MS = 5.0
+
+
+def bench_auto():
+    print(f"auto colour + position analysis (ms, best of 20, budget {AUTO_BUDGET_MS:g} ms)")
+    print(f"{'resolution':>12} {'analysis':>9} {'full render':>12} {'share':>7} {'budget':>7}")
+    for w, h in RESOLUTIONS:
+        raw = synth_jpeg(w, h, photo=True)
+        img = Image.open(BytesIO(raw))
+        img.load()
+
+        auto = best_ms(lambda: bot.auto_style(img, "auto", True), 20)
+        settings = dict(bot.DEFAULT_SETTINGS, color="auto", position="auto")
+        render = best_ms(lambda: bot.create_watermark(raw, bot.DEFAULT_WATERMARK, settings))
+        ok = "OK" if auto < AUTO_BUDGET_MS else "OVER"
+        print(f"{f'{w}x{h}':>12} {auto:>9.3f} {render:>12.1f} {auto / render:>6.1%} {ok:>7}")
+
+
+# ------------------------------------------------------------
+# ANIM: 200-frame GIF / WebP watermark
+# ------------------------------------------------------------
+def synth_animation(fmt: str, frames: int = 200, size=(480, 270)) -> bytes:
+    from PIL import ImageDraw
+
+    bg = synth_image(*size)
+    seq = []
+    for i in range(frames):
+        fr = bg.copy()
+        x = (i * 3) % size[0]
+        ImageDraw.Draw(fr).ellipse((x, 100, x + 60, 160), fill=(255, 80, 0))
+        seq.append(fr)
+    out = BytesIO()
+    seq[0].save(out, fmt, save_all=True, append_images=seq[1:], duration=40, loop=0)
+    return out.getvalue()
+
+
+def _anim_naive(raw: bytes, settings: dict) -> bytes:
+    # seedha tareeka: har frame pe poora watermark + Pillow ke default encode options
+    from PIL import ImageSequence
+
+    img = Image.open(BytesIO(raw))
+    plan = bot.watermark_plan(bot.DEFAULT_WATERMARK, settings)
+    frames = []
+    for frame in ImageSequence.Iterator(img):
+        fr = frame.convert("RGB")
+        bot.apply_watermark(fr, plan)
+        frames.append(fr)
+    out = BytesIO()
+    frames[0].save(out, img.format, save_all=True, append_images=frames[1:], duration=40, loop=0)
+    return out.getvalue()
+
+
+def bench_anim():
+    print("200-frame 480x270 animation watermark (ms, best of 3)")
+    print(f"{'format':>8} {'naive':>8} {'engine':>8} {'speedup':>8} {'in KB':>7} {'out KB':>7}")
+    for fmt in ("GIF", "WEBP"):
+        raw = synth_animation(fmt)
+        naive = best_ms(lambda: _anim_naive(raw, bot.DEFAULT_SETTINGS), 3)
+        engine = best_ms(lambda: bot.create_watermark(raw, bot.DEFAULT_WATERMARK, bot.DEFAULT_SETTINGS), 3)
+        out = bot.create_watermark(raw, bot.DEFAULT_WATERMARK, bot.DEFAULT_SETTINGS)
+        print(
+            f"{fmt:>8} {naive:>8.0f} {engine:>8.0f} {naive / engine:>7.1f}x "
+            f"{len(raw) / 1024:>7.0f} {len(out) / 1024:>7.0f}"
+        )
+
+
+BENCHES = {
+    "diagonal": bench_diagonal,
+    "copies": bench_copies,
+    "blend": bench_blend,
+    "effects": bench_effects,
+    "glyphs": bench_glyphs,
+    "layout": bench_layout,
+    "buckets": bench_buckets,
+    "auto": bench_auto,
+    "anim": bench_anim,
+}
+
+
+def main():
+    if sys.argv[1:2] == ["_copy_path"]:
+        return _copy_path(sys.argv[2], int(sys.argv[3]), int(sys.argv[4]), sys.argv[5])
+
+    names = sys.argv[1:] or list(BENCHES)
+    for name in names:
+        BENCHES[name]()
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,35 @@
 import os
+import dbm
+import hashlib
+import json
 import logging
+import math
+import mmap
+import sys
+import tempfile
+import time
+import unicodedata
 from io import BytesIO
 import asyncio
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime
 
-from PIL import Image, ImageDraw, ImageFont
+from PIL import (
+    Image, ImageChops, ImageDraw, ImageFilter, ImageFont, ImageSequence, ImageStat,
+    features,
+)
+
+try:
+    import numpy as np  # optional: vectorized watermark blend
+except ImportError:
+    np = None
+try:
+    import pyvips
+except (ImportError, OSError):  # OSError: libvips hi installed nahi
+    pyvips = None
 from motor.motor_asyncio import AsyncIOMotorClient
 from telegram import (
     Update,
@@ -19,7 +44,7 @@ from telegram.ext import (
     ContextTypes,
     filters,
 )
-from telegram.error import Forbidden, BadRequest
+from telegram.error import Forbidden, BadRequest, NetworkError
 
 logging.basicConfig(
     format="%(asctime)s — %(name)s — %(levelname)s — %(message)s",
@@ -41,6 +66,53 @@ FORCE_SUB_URL = os.getenv("FORCE_SUB_URL", "")  # अगर direct channel link
 FORCE_PHOTO_URL = os.getenv("FORCE_PHOTO_URL", "https://files.catbox.moe/wqop01.jpg")
 OWNER_CONTACT = os.getenv("OWNER_CONTACT", "@saini_sahab_19")
 
+# RENDER EXECUTOR CONFIG
+RENDER_MODE = os.getenv("RENDER_MODE", "process")  # process / thread / inline
+RENDER_WORKERS = int(os.getenv("RENDER_WORKERS", str(min(4, os.cpu_count() or 1))))
+RENDER_QUEUE = int(os.getenv("RENDER_QUEUE", "16"))  # workers busy hon to itne job wait kar sakte hain
+RENDER_TIMEOUT = float(os.getenv("RENDER_TIMEOUT", "30"))  # per-job seconds
+
+# OUTPUT SIZE (0 = original resolution). Bade inputs decode ke waqt hi chhote ho jaate hain
+MAX_OUTPUT_DIM = int(os.getenv("MAX_OUTPUT_DIM", "0"))
+
+# INPUT LIMITS — Telegram ke bataye width / height / file_size se download se
+# pehle hi reject (decompression-bomb guard). 0 = no limit
+MAX_INPUT_PIXELS = int(os.getenv("MAX_INPUT_PIXELS", "50000000"))
+MAX_INPUT_MB = float(os.getenv("MAX_INPUT_MB", "20"))  # Bot API getFile bhi 20 MB tak hi deta hai
+
+# OUTPUT ENCODER — naye users ka default profile (ENCODER_PROFILES keys)
+ENCODER_PROFILE = os.getenv("ENCODER_PROFILE", "jpeg_90")
+
+# MEMORY BUDGET per render (MB, 0 = no limit). Set ho to decode isme fit kiya
+# jaata hai aur bade watermark regions horizontal strips me blend hote hain
+RENDER_MEM_MB = float(os.getenv("RENDER_MEM_MB", "0"))
+
+# RENDER BACKEND — auto = startup pe self-benchmark; pillow / numpy / vips = fixed
+RENDER_BACKEND = os.getenv("RENDER_BACKEND", "auto")
+
+# RESULT CACHE — same photo + text + settings dobara aaye to pichhla Telegram file_id
+# resend hota hai. DIR set ho to disk tier bhi (restart ke baad bhi hits),
+# max DISK_ITEMS entries — sabse purane (last use se) hat jaate hain
+RESULT_CACHE_SIZE = int(os.getenv("RESULT_CACHE_SIZE", "4096"))
+RESULT_CACHE_DIR = os.getenv("RESULT_CACHE_DIR", "")
+RESULT_CACHE_DISK_ITEMS = int(os.getenv("RESULT_CACHE_DISK_ITEMS", "200000"))
+
+# ORIGINALS CACHE — downloaded photos disk pe file_unique_id se (forwarded / re-sent
+# images pe get_file + download skip). DIR khali = off
+ORIGINALS_CACHE_DIR = os.getenv("ORIGINALS_CACHE_DIR", "")
+ORIGINALS_CACHE_MB = float(os.getenv("ORIGINALS_CACHE_MB", "512"))
+
+# FONT DIRS — startup pe inhe scan karke font registry banti hai (os.pathsep separated)
+FONT_DIRS = os.getenv("FONT_DIRS", "/usr/share/fonts:/usr/local/share/fonts:~/.fonts")
+
+# ENGINE CACHES (har render worker ka apna cache hota hai)
+FONT_CACHE_SIZE = int(os.getenv("FONT_CACHE_SIZE", "64"))  # (font_key, size) entries
+STAMP_CACHE_MB = float(os.getenv("STAMP_CACHE_MB", "32"))  # pre-rendered text stamps
+# font size geometric ladder pe snap hota hai, max itna relative farak (0 = off)
+FONT_SIZE_STEP = float(os.getenv("FONT_SIZE_STEP", "0.03"))
+GLYPH_ATLAS_KB = int(os.getenv("GLYPH_ATLAS_KB", "1024"))  # har (font path, size) atlas ka budget
+GLYPH_ATLAS_FONTS = int(os.getenv("GLYPH_ATLAS_FONTS", "32"))  # kitne atlases ek saath
+
 if not BOT_TOKEN:
     raise RuntimeError("BOT_TOKEN env missing")
 if not MONGO_URL:
@@ -56,10 +128,12 @@ users_col = db["users"]
 # ------------------------------------------------------------
 # TEMP MEMORY
 # ------------------------------------------------------------
-PENDING = {}      # user_id -> {"img": bytes, "task": asyncio.Task, "chat_id": int}
+PENDING = {}      # user_id -> {"media", "img": bytes | None, "task": asyncio.Task, "chat_id": int}
 USER_STATE = {}   # user_id -> state string
 
 TIMEOUT = 20
+UPLOAD_FAILED = "❌ Watermarked file upload nahi ho payi. Dusra output format ya chhoti photo try karo."
+UNREADABLE_IMAGE = "❌ Ye file image ki tarah read nahi ho payi. JPG / PNG / GIF / WebP bhejo."
 DEFAULT_WATERMARK = "@RPSC_RSMSSB_BOARD"
 
 # ------------------------------------------------------------
@@ -72,6 +146,10 @@ DEFAULT_SETTINGS = {
     "position": "bottom_right",
     "font_key": "sans_default",
     "transform": "normal",
+    "effect": "shadow",  # TEXT_EFFECTS keys
+    "encoder": ENCODER_PROFILE,
+    "mode": "text",  # text / logo
+    "logo": None,    # {"file_id", "uid", "png"} — upload ke baad
 }
 
 # ------------------------------------------------------------
@@ -139,6 +217,32 @@ FALLBACK_FONTS = [
     "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf",
 ]
 
+# ------------------------------------------------------------
+# OUTPUT ENCODER PROFILES
+# ------------------------------------------------------------
+# key -> (label, PIL format, extension, save params)
+# CPU vs upload bytes ka trade-off; chhota upload = reply_photo jaldi complete
+ENCODER_PROFILES = {
+    "jpeg_90": ("JPEG 90", "JPEG", "jpg", {"quality": 90}),
+    "jpeg_small": (
+        "JPEG Small",
+        "JPEG",
+        "jpg",
+        {"quality": 80, "optimize": True, "progressive": True, "subsampling": "4:2:0"},
+    ),
+    "jpeg_hq": (
+        "JPEG HQ",
+        "JPEG",
+        "jpg",
+        {"quality": 95, "optimize": True, "subsampling": "4:4:4"},
+    ),
+    # source JPEG ki quality tables + subsampling hi rakhta hai
+    "jpeg_keep": ("JPEG Original", "JPEG", "jpg", {"quality": "keep", "subsampling": "keep"}),
+    "webp": ("WebP", "WEBP", "webp", {"quality": 85, "method": 4}),
+    "webp_small": ("WebP Small", "WEBP", "webp", {"quality": 75, "method": 6}),
+    "png": ("PNG Lossless", "PNG", "png", {"compress_level": 6}),
+}
+
 # ------------------------------------------------------------
 # DATABASE FUNCTIONS
 # ------------------------------------------------------------
@@ -245,26 +349,266 @@ async def ensure_subscribed(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
     return True
 
+# ------------------------------------------------------------
+# LRU CACHE
+# ------------------------------------------------------------
+class LRUCache:
+    """
+    Chhota thread-safe LRU cache, max_items (aur optional max_bytes) se bounded.
+    max_bytes ke liye sizeof(value) har entry ka size batata hai; on_evict(key,
+    value) evict hui entry ke saath (jaise disk file delete).
+    hits / misses counters production me cache check karne ke liye hain.
+    """
+
+    def __init__(self, max_items: int, max_bytes: int = 0, sizeof=None, on_evict=None):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.on_evict = on_evict
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._sizes = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        size = self.sizeof(value) if self.sizeof else 0
+        if self.max_bytes and size > self.max_bytes:
+            return  # akela hi budget se bada, cache nahi karte
+        with self._lock:
+            self.bytes += size - self._sizes.get(key, 0)
+            self._data[key] = value
+            self._sizes[key] = size
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_items or (
+                self.max_bytes and self.bytes > self.max_bytes
+            ):
+                old_key, old = self._data.popitem(last=False)
+                self.bytes -= self._sizes.pop(old_key)
+                if self.on_evict:
+                    self.on_evict(old_key, old)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._sizes.clear()
+            self.bytes = 0
+
+    def stats(self) -> dict:
+        return {
+            "items": len(self._data),
+            "bytes": self.bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
 # ------------------------------------------------------------
 # FONT HELPERS
 # ------------------------------------------------------------
-def load_font(font_key: str, size: int) -> ImageFont.FreeTypeFont:
-    entry = FONT_STYLES.get(font_key) or FONT_STYLES["sans_default"]
-    label, paths = entry
+FONT_CACHE = LRUCache(FONT_CACHE_SIZE)  # (font_key, size, layout) -> FreeTypeFont
+FONT_PATHS = {}  # font_key -> jo path chal gaya (None = PIL default font)
 
-    for p in paths:
-        try:
-            return ImageFont.truetype(p, size)
-        except Exception:
+# ------------------------------------------------------------
+# FONT REGISTRY
+# ------------------------------------------------------------
+# Startup pe FONT_DIRS ek baar scan hote hain; FONT_STYLES ke paths yahin
+# validate hoke FONT_PATHS me fix ho jaate hain, isliye render ke waqt koi
+# path probing nahi hoti. Registry build na hui ho (bench, scripts) to
+# load_font purane tareeke se probe karta hai.
+FONT_INDEX = {}        # path -> {"family", "style", "path", "scripts"}
+FONT_AVAILABLE = None  # FONT_STYLES keys jinki apni font file mili (None = registry nahi bani)
+FONT_EXTS = (".ttf", ".otf", ".ttc")
+
+# script -> sample chars; font me ye glyphs .notdef se alag hon to script supported
+SCRIPT_SAMPLES = {
+    "latin": "Aa",
+    "devanagari": "कख",
+    "cyrillic": "Жж",
+    "greek": "Ωω",
+    "arabic": "بت",
+}
+
+
+# startup pe workers me pehle se load hone wale fonts: Telegram photos (1280 / 960 px
+# side) x size menu factors — wahi font_size jo watermark_layers nikalta hai
+PRELOAD_SIDES = (1280, 960)
+PRELOAD_FACTORS = (0.7, 1.0, 1.4, 1.8)
+
+
+def _glyph_raster(font: ImageFont.FreeTypeFont, ch: str):
+    x0, y0, x1, y1 = font.getbbox(ch)
+    im = Image.new("L", (max(1, x1 - x0), max(1, y1 - y0)), 0)
+    ImageDraw.Draw(im).text((-x0, -y0), ch, font=font, fill=255)
+    return im.size, im.tobytes()
+
+
+def font_scripts(font: ImageFont.FreeTypeFont) -> set:
+    """Font kaun se scripts render kar sakta hai (missing glyph .notdef box ban jaata hai)."""
+    notdef = _glyph_raster(font, "\uffff")
+    return {
+        script
+        for script, sample in SCRIPT_SAMPLES.items()
+        if all(_glyph_raster(font, ch) != notdef for ch in sample)
+    }
+
+
+def scan_fonts(dirs: str = FONT_DIRS) -> dict:
+    """FONT_DIRS ke saare font files ka index: path -> family / style / scripts."""
+    index = {}
+    for root_dir in dirs.split(os.pathsep):
+        root_dir = os.path.expanduser(root_dir)
+        for root, _, files in os.walk(root_dir):
+            for name in sorted(files):
+                if not name.lower().endswith(FONT_EXTS):
+                    continue
+                path = os.path.join(root, name)
+                entry = index_font(path)
+                if entry:
+                    index[path] = entry
+    return index
+
+
+def index_font(path: str):
+    """Ek font file ki index entry (family / style / scripts), na khule to None."""
+    try:
+        font = ImageFont.truetype(path, 24)
+    except OSError as e:
+        logger.warning(f"Font skip {path}: {e}")
+        return None
+    family, style = font.getname()
+    return {"family": family, "style": style, "path": path, "scripts": font_scripts(font)}
+
+
+def font_file_ok(path: str) -> bool:
+    """FONT_STYLES / FALLBACK_FONTS ka path seedha validate (FONT_DIRS ke bahar bhi ho sakta hai)."""
+    if path not in FONT_INDEX and os.path.isfile(path):
+        entry = index_font(path)
+        if entry:
+            FONT_INDEX[path] = entry
+    return path in FONT_INDEX
+
+
+def build_font_registry():
+    """
+    Startup pe: fonts scan, har FONT_STYLES entry ka path validate/fix, aur
+    common faces FONT_CACHE me preload. Render pool banne se pehle call karo
+    taaki forked workers ko ye sab mil jaaye. Styles ke paths seedha check
+    hote hain; FONT_DIRS scan sirf index me aur fonts jodta hai.
+    """
+    global FONT_INDEX, FONT_AVAILABLE
+    FONT_INDEX = scan_fonts()
+
+    fallback = next((p for p in FALLBACK_FONTS if font_file_ok(p)), None)
+    FONT_AVAILABLE = []
+    for key, (label, paths) in FONT_STYLES.items():
+        path = next((p for p in paths if font_file_ok(p)), None)
+        if path:
+            FONT_AVAILABLE.append(key)
+        else:
+            logger.warning(f"Font style {key} ({label}): koi file nahi mili, menu se hata diya")
+        # purane users jinke settings me ye key hai unhe fallback milta hai
+        FONT_PATHS[key] = path or fallback
+    if "sans_default" not in FONT_AVAILABLE:
+        FONT_AVAILABLE.insert(0, "sans_default")  # PIL default font pe bhi chalta hai
+
+    preload_fonts(dict(FONT_PATHS))
+    scripts = sorted(set().union(*(f["scripts"] for f in FONT_INDEX.values())))
+    logger.info(
+        f"Fonts: {len(FONT_INDEX)} files indexed, "
+        f"{len(FONT_AVAILABLE)}/{len(FONT_STYLES)} styles available, scripts: {', '.join(scripts)}"
+    )
+
+
+def preload_fonts(paths: dict):
+    """Resolved paths set karke default font ke common sizes load (render workers ka initializer bhi)."""
+    FONT_PATHS.update(paths)
+    layout = text_layout(DEFAULT_WATERMARK)
+    sizes = {font_size_for(side, factor) for side in PRELOAD_SIDES for factor in PRELOAD_FACTORS}
+    for size in sorted(sizes):
+        load_font(DEFAULT_SETTINGS["font_key"], size, layout)
+
+
+# ------------------------------------------------------------
+# LAYOUT ENGINE
+# ------------------------------------------------------------
+# RAQM (harfbuzz + fribidi) Devanagari / Arabic / emoji ko sahi shape karta
+# hai par plain ASCII handles pe BASIC se kaafi mehenga hai. Har text ke
+# liye script dekh ke layout chunte hain; fonts har layout ke liye alag
+# cache hote hain. libraqm na ho to sab kuch BASIC (Pillow ka bhi yahi default).
+HAVE_RAQM = features.check("raqm")
+LAYOUT_DEFAULT = ImageFont.Layout.RAQM if HAVE_RAQM else ImageFont.Layout.BASIC
+
+# Latin, IPA, Greek, Cyrillic (0000-052F) ke alawa ye blocks bhi BASIC me
+# sahi aate hain: Latin Extended Additional, Greek Extended, punctuation,
+# currency, letterlike symbols
+BASIC_RANGES = ((0x1E00, 0x1FFF), (0x2000, 0x20CF), (0x2100, 0x214F))
+
+
+def needs_shaping(text: str) -> bool:
+    """Kya text ko RAQM shaping chahiye (combining marks, complex scripts, emoji sequences)."""
+    if text.isascii():
+        return False
+    for ch in text:
+        if unicodedata.category(ch) in ("Mn", "Me", "Cf"):
+            return True  # combining marks, ZWJ / ZWNJ, bidi controls
+        cp = ord(ch)
+        if cp <= 0x052F or any(lo <= cp <= hi for lo, hi in BASIC_RANGES):
             continue
+        return True
+    return False
+
+
+def text_layout(text: str) -> int:
+    if HAVE_RAQM and needs_shaping(text):
+        return ImageFont.Layout.RAQM
+    return ImageFont.Layout.BASIC
 
-    for p in FALLBACK_FONTS:
+
+def load_font(font_key: str, size: int, layout: int = LAYOUT_DEFAULT) -> ImageFont.FreeTypeFont:
+    key = (font_key, size, layout)
+    font = FONT_CACHE.get(key)
+    if font is not None:
+        return font
+
+    # path ek baar resolve ho gaya to missing files dobara probe nahi hoti
+    if font_key in FONT_PATHS:
+        candidates = [FONT_PATHS[font_key]]
+    else:
+        entry = FONT_STYLES.get(font_key) or FONT_STYLES["sans_default"]
+        label, paths = entry
+        candidates = paths + FALLBACK_FONTS
+
+    for p in candidates:
+        if p is None:
+            break
         try:
-            return ImageFont.truetype(p, size)
+            font = ImageFont.truetype(p, size, layout_engine=layout)
         except Exception:
             continue
+        FONT_PATHS[font_key] = p
+        break
+
+    if font is None:
+        FONT_PATHS[font_key] = None
+        font = ImageFont.load_default()
+
+    FONT_CACHE.put(key, font)
+    return font
 
-    return ImageFont.load_default()
+
+def font_choices() -> list:
+    """Font menu me dikhne wali keys: registry bani ho to sirf available fonts."""
+    return list(FONT_STYLES) if FONT_AVAILABLE is None else FONT_AVAILABLE
 
 
 def font_label(font_key: str) -> str:
@@ -274,6 +618,13 @@ def font_label(font_key: str) -> str:
     return entry[0]
 
 
+def style_label(settings: dict) -> str:
+    """Reply caption ke liye: logo mode me "Logo", warna font ka naam."""
+    if settings.get("mode") == "logo" and settings.get("logo"):
+        return "Logo 🖼"
+    return f"Font: {font_label(settings['font_key'])}"
+
+
 def apply_transform(text: str, transform: str) -> str:
     if transform == "upper":
         return text.upper()
@@ -288,69 +639,1248 @@ def apply_transform(text: str, transform: str) -> str:
 # ------------------------------------------------------------
 # WATERMARK ENGINE
 # ------------------------------------------------------------
-def create_watermark(img_bytes: bytes, text: str, settings: dict) -> bytes:
-    img = Image.open(BytesIO(img_bytes)).convert("RGBA")
+class RenderTooLarge(Exception):
+    """Image RENDER_MEM_MB budget me decode nahi ho sakti."""
 
-    size_factor = settings.get("size_factor", 1.0)
-    color = tuple(settings.get("color", (255, 255, 255)))
-    alpha = int(settings.get("alpha", 220))
-    position = settings.get("position", "bottom_right")
-    font_key = settings.get("font_key", "sans_default")
-    transform = settings.get("transform", "normal")
 
-    text = apply_transform(text, transform)
+# blend ka working set per pixel (crop + uint16 region + planes), strip size ke liye
+BLEND_BYTES_PER_PX = 24
 
-    W, H = img.size
-    txt_layer = Image.new("RGBA", img.size, (0, 0, 0, 0))
-    draw = ImageDraw.Draw(txt_layer)
+SHADOW_FILL = (0, 0, 0, 160)
+SHADOW_OFFSET = 2
 
-    base_size = max(20, W // 20)
-    font_size = max(10, int(base_size * size_factor))
-    font = load_font(font_key, font_size)
+# text effects: "shadow" (default, purana look), "outline" (stroke), "soft" (blurred shadow)
+TEXT_EFFECTS = {"shadow": "Shadow", "outline": "Outline", "soft": "Soft Shadow"}
 
-    bbox = draw.textbbox((0, 0), text, font=font)
-    tw = bbox[2] - bbox[0]
-    th = bbox[3] - bbox[1]
-    margin = 20
+# "tile" position: text poori photo pe repeat hota hai
+TILE_ANGLE = 30
+TILE_SPACING = 1.0   # copies ke beech gap, font size ke multiple me
+TILE_TEXTURE = 1024  # cached texture ka budget ~ TILE_TEXTURE^2 px (isse bada period = texture nahi)
+
+
+def bucket_size(size: int, step: float = None) -> int:
+    """
+    Size ko geometric ladder (ratio (1 + step)^2) ke nearest rung pe snap karta
+    hai, taaki alag-alag widths ki images same font size / stamp share karein.
+    Farak kabhi step se zyada nahi hota; chhote sizes pe integer rounding se
+    zyada ho jaaye to size jaisa hai waisa rehta hai.
+    """
+    step = FONT_SIZE_STEP if step is None else step
+    if step <= 0:
+        return size
+    ratio = math.log((1 + step) ** 2)
+    snapped = round(math.exp(round(math.log(size) / ratio) * ratio))
+    return snapped if abs(snapped - size) <= step * size else size
+
+
+def font_size_for(width: int, size_factor: float) -> int:
+    """Image width + size setting se watermark font size (bucketed)."""
+    return bucket_size(max(10, int(max(20, width // 20) * size_factor)))
+
+
+def _image_nbytes(value) -> int:
+    img = value[0] if isinstance(value, tuple) else value
+    return img.width * img.height * len(img.getbands())
+
+
+# (text, font_key, font_size, color, alpha, transform, effect) -> (stamp, bbox)
+# ("mask" / "soft", text, font_key, font_size, transform) -> rasterized glyph masks
+STAMP_CACHE = LRUCache(
+    max_items=1024,
+    max_bytes=int(STAMP_CACHE_MB * 1024 * 1024),
+    sizeof=_image_nbytes,
+)
+
+
+# ------------------------------------------------------------
+# GLYPH ATLAS
+# ------------------------------------------------------------
+# Watermark texts chhote alphabet se bante hain, isliye har glyph ek baar
+# rasterize karke (font path, size) ke atlas me rakhte hain aur text unhi
+# bitmaps + kerning se compose hota hai. Sirf BASIC layout ke liye — wahan
+# har codepoint ek glyph hai, pen position nearest pixel pe round hoti hai
+# aur overlapping glyphs "over" blend hote hain (solid 255 glyph mask se paste),
+# isliye output draw.text jaisa hi
+# byte-for-byte aata hai. Shaping (RAQM) wale text draw.text se hi bante hain.
+ATLAS_CACHE = LRUCache(GLYPH_ATLAS_FONTS)  # (font path, size) -> LRUCache of glyphs / kern pairs
+
+
+def _glyph_nbytes(value) -> int:
+    mask = value[0]
+    return 16 if mask is None else mask.width * mask.height  # kern pairs / blank glyphs ~ free
+
+
+def glyph_atlas(font: ImageFont.FreeTypeFont) -> LRUCache:
+    key = (font.path, font.size)
+    atlas = ATLAS_CACHE.get(key)
+    if atlas is None:
+        atlas = LRUCache(max_items=4096, max_bytes=GLYPH_ATLAS_KB * 1024, sizeof=_glyph_nbytes)
+        ATLAS_CACHE.put(key, atlas)
+    return atlas
+
+
+def atlas_glyph(atlas: LRUCache, font: ImageFont.FreeTypeFont, ch: str):
+    """Ek glyph: (mask | None, bbox, advance). Blank glyphs (space) ka mask None."""
+    glyph = atlas.get(ch)
+    if glyph is None:
+        bbox = font.getbbox(ch)
+        x0, y0, x1, y1 = bbox
+        mask = None
+        if x1 > x0 and y1 > y0:
+            mask = Image.new("L", (x1 - x0, y1 - y0), 0)
+            ImageDraw.Draw(mask).text((-x0, -y0), ch, font=font, fill=255)
+        glyph = (mask, bbox, font.getlength(ch))
+        atlas.put(ch, glyph)
+    return glyph
+
+
+def atlas_kern(atlas: LRUCache, font: ImageFont.FreeTypeFont, a: str, b: str) -> float:
+    key = (a, b)
+    kern = atlas.get(key)
+    if kern is None:
+        kern = (None, font.getlength(a + b) - font.getlength(a) - font.getlength(b))
+        atlas.put(key, kern)
+    return kern[1]
+
+
+def atlas_ok(font, text: str) -> bool:
+    """Kya ye text atlas se compose ho sakta hai (warna draw.text)."""
+    return (
+        isinstance(font, ImageFont.FreeTypeFont)
+        and font.layout_engine == ImageFont.Layout.BASIC
+        and "\n" not in text
+    )
+
+
+def atlas_text_mask(font: ImageFont.FreeTypeFont, text: str):
+    """Cached glyph bitmaps se text ka L mask. Returns (mask, bbox) — draw.text jaisa."""
+    atlas = glyph_atlas(font)
+    placed = []
+    pen = 0.0
+    prev = None
+    for ch in text:
+        if prev is not None:
+            pen += atlas_kern(atlas, font, prev, ch)
+        mask, (gx0, gy0, gx1, gy1), advance = atlas_glyph(atlas, font, ch)
+        if mask is not None:
+            x = math.floor(pen + 0.5)
+            placed.append((mask, x + gx0, gy0, x + gx1, gy1))
+        pen += advance
+        prev = ch
+
+    bbox = font.getbbox(text)
+    x0, y0, x1, y1 = bbox
+    out = Image.new("L", (max(1, x1 - x0), max(1, y1 - y0)), 0)
+    for mask, gx0, gy0, gx1, gy1 in placed:
+        box = (gx0 - x0, gy0 - y0, gx1 - x0, gy1 - y0)
+        out.paste(255, box, mask)
+    return out, bbox
+
+
+def glyph_mask(text: str, font_key: str, font_size: int, transform: str):
+    """
+    Text ka L-mode glyph mask, ek hi baar rasterize hota hai — colour, alpha
+    ya effect badalne pe yahi mask reuse hota hai. Returns (mask, bbox).
+    """
+    key = ("mask", text, font_key, font_size, transform)
+    cached = STAMP_CACHE.get(key)
+    if cached is not None:
+        return cached
+
+    shown = apply_transform(text, transform)
+    font = load_font(font_key, font_size, text_layout(shown))
+    if atlas_ok(font, shown):
+        mask, bbox = atlas_text_mask(font, shown)
+    else:
+        bbox = font.getbbox(shown)
+        x0, y0, x1, y1 = bbox
+        mask = Image.new("L", (max(1, x1 - x0), max(1, y1 - y0)), 0)
+        ImageDraw.Draw(mask).text((-x0, -y0), shown, font=font, fill=255)
+
+    STAMP_CACHE.put(key, (mask, bbox))
+    return mask, bbox
+
+
+def soft_shadow(text: str, font_key: str, font_size: int, transform: str):
+    """Glyph mask ka blurred version, SHADOW_FILL alpha tak scaled. Returns (shadow, pad)."""
+    key = ("soft", text, font_key, font_size, transform)
+    cached = STAMP_CACHE.get(key)
+    if cached is not None:
+        return cached
+
+    mask, _ = glyph_mask(text, font_key, font_size, transform)
+    radius = max(2, font_size // 12)
+    offset = max(SHADOW_OFFSET, font_size // 24)
+    pad = 2 * radius
+    shadow = Image.new("L", (mask.width + 2 * pad + offset, mask.height + 2 * pad + offset), 0)
+    shadow.paste(mask, (pad + offset, pad + offset))
+    shadow = shadow.filter(ImageFilter.GaussianBlur(radius))
+    shadow = shadow.point([v * SHADOW_FILL[3] // 255 for v in range(256)])
+
+    STAMP_CACHE.put(key, (shadow, pad))
+    return shadow, pad
+
+
+def get_stamp(text: str, font_key: str, font_size: int, color: tuple, alpha: int, transform: str,
+              effect: str = "shadow"):
+    """
+    Text + effect ko ek tight RGBA "stamp" me ek hi baar render karta hai.
+    Returns (stamp, bbox): bbox text origin (0, 0) ke relative box hai,
+    stamp ka top-left origin se (bbox[0], bbox[1]) pe padta hai.
+    """
+    key = (text, font_key, font_size, color, alpha, transform, effect)
+    cached = STAMP_CACHE.get(key)
+    if cached is not None:
+        return cached
 
     main_fill = (*color, max(0, min(alpha, 255)))
-    shadow_fill = (0, 0, 0, 160)
 
-    def put(x: int, y: int, dr: ImageDraw.ImageDraw):
-        dr.text((x + 2, y + 2), text, font=font, fill=shadow_fill)
-        dr.text((x, y), text, font=font, fill=main_fill)
+    if effect == "outline":
+        # stroke Pillow khud glyph ke saath banata hai; dark text pe safed outline
+        shown = apply_transform(text, transform)
+        font = load_font(font_key, font_size, text_layout(shown))
+        sw = max(1, round(font_size / 18))
+        bbox = font.getbbox(shown, stroke_width=sw)
+        x0, y0, x1, y1 = bbox
+        luma = (299 * color[0] + 587 * color[1] + 114 * color[2]) // 1000
+        stroke = ((0, 0, 0) if luma > 96 else (255, 255, 255)) + (main_fill[3],)
+        stamp = Image.new("RGBA", (max(1, x1 - x0), max(1, y1 - y0)), (0, 0, 0, 0))
+        ImageDraw.Draw(stamp).text(
+            (-x0, -y0), shown, font=font, fill=main_fill, stroke_width=sw, stroke_fill=stroke
+        )
+    elif effect == "soft":
+        mask, (x0, y0, x1, y1) = glyph_mask(text, font_key, font_size, transform)
+        shadow, pad = soft_shadow(text, font_key, font_size, transform)
+        stamp = Image.new("RGBA", shadow.size, (0, 0, 0, 0))
+        stamp.putalpha(shadow)
+        stamp.paste(main_fill, (pad, pad, pad + mask.width, pad + mask.height), mask)
+        bbox = (x0 - pad, y0 - pad, x1 + pad, y1 + pad)
+    else:
+        # shadow aur fill dono ek hi rasterized mask se (pehle do baar draw.text hota tha)
+        mask, bbox = glyph_mask(text, font_key, font_size, transform)
+        x0, y0, x1, y1 = bbox
+        stamp = Image.new(
+            "RGBA",
+            (max(1, x1 - x0 + SHADOW_OFFSET), max(1, y1 - y0 + SHADOW_OFFSET)),
+            (0, 0, 0, 0),
+        )
+        w, h = mask.size
+        off = SHADOW_OFFSET
+        stamp.paste(SHADOW_FILL, (off, off, off + w, off + h), mask)
+        stamp.paste(main_fill, (0, 0, w, h), mask)
+
+    STAMP_CACHE.put(key, (stamp, bbox))
+    return stamp, bbox
+
+
+def rotated_stamp(skey: tuple, stamp: Image.Image, angle: int) -> Image.Image:
+    """Stamp ka rotate(angle, expand=True) version, per angle cached (skey = stamp ki cache key)."""
+    key = ("rot", angle, *skey)
+    cached = STAMP_CACHE.get(key)
+    if cached is not None:
+        return cached
+
+    rot = stamp.rotate(angle, expand=True)
+    STAMP_CACHE.put(key, rot)
+    return rot
+
+
+def tile_cell(skey: tuple, stamp: Image.Image, font_size: int, spacing: float, angle: int):
+    """Tile pattern ka ek cell: (rotated stamp, cell width, cell height)."""
+    rot = rotated_stamp(skey, stamp, angle)
+    gap = max(8, int(font_size * spacing))
+    return rot, rot.width + gap, rot.height + gap
+
+
+def tile_texture(skey: tuple, stamp: Image.Image, font_size: int, spacing: float,
+                 angle: int):
+    """
+    Rotated stamp ki brick-pattern texture, ek hi baar bana ke cached.
+    Texture seamless hai, isliye photo pe bas side-by-side blend karni hoti hai.
+    Minimal period (1 cell x 2 rows) hai, chhota ho to TILE_TEXTURE tak repeat;
+    period khud TILE_TEXTURE^2 se bada ho to None (caller stamps seedhe lagata hai).
+    """
+    key = ("tile", angle, spacing, *skey)
+    cached = STAMP_CACHE.get(key)
+    if cached is not None:
+        return cached
+
+    rot, cw, ch = tile_cell(skey, stamp, font_size, spacing, angle)
+    if cw * 2 * ch > TILE_TEXTURE * TILE_TEXTURE:
+        return None
+    nx = max(1, TILE_TEXTURE // cw)
+    ny = max(1, TILE_TEXTURE // (2 * ch))
+
+    texture = Image.new("RGBA", (nx * cw, 2 * ny * ch), (0, 0, 0, 0))
+    for row in range(2 * ny):
+        # har dusri row aadhe cell se shifted; -1 wali copy left edge wrap karti hai
+        shift = (cw // 2) if row % 2 else 0
+        for col in range(-1, nx):
+            texture.paste(rot, (col * cw + shift, row * ch))
+
+    STAMP_CACHE.put(key, texture)
+    return texture
+
+
+def get_tile_texture(text: str, font_key: str, font_size: int, color: tuple, alpha: int,
+                     transform: str, spacing: float, angle: int, effect: str = "shadow") -> Image.Image:
+    stamp, _ = get_stamp(text, font_key, font_size, color, alpha, transform, effect)
+    skey = (text, font_key, font_size, color, alpha, transform, effect)
+    return tile_texture(skey, stamp, font_size, spacing, angle)
+
+
+def rotate_point(px: float, py: float, W: int, H: int, angle: int):
+    """
+    Point (px, py) us jagah map hota hai jahan W x H frame ko
+    rotate(angle, expand=True) karke beech se W x H crop karne pe jaata.
+    """
+    phi = -math.radians(angle % 360)
+    a, b = round(math.cos(phi), 15), round(math.sin(phi), 15)
+    cx, cy = W / 2, H / 2
+
+    # PIL.Image.rotate(expand=True) wala output size
+    xs, ys = [], []
+    for x, y in ((0, 0), (W, 0), (W, H), (0, H)):
+        xs.append(a * (x - cx) + b * (y - cy) + cx)
+        ys.append(-b * (x - cx) + a * (y - cy) + cy)
+    rw = math.ceil(max(xs)) - math.floor(min(xs))
+    rh = math.ceil(max(ys)) - math.floor(min(ys))
+
+    ox = rw / 2 - max(0, (rw - W) // 2)
+    oy = rh / 2 - max(0, (rh - H) // 2)
+    dx, dy = px - cx, py - cy
+    return a * dx - b * dy + ox, b * dx + a * dy + oy
+
+
+def rotate_matrix(W: int, H: int, angle: int):
+    """
+    W x H frame ke rotate(angle, expand=True) ka inverse affine matrix + output
+    size, Pillow ke Image.rotate wale hi float steps me (rounding same rahe).
+    """
+    phi = -math.radians(angle % 360)
+    m = [
+        round(math.cos(phi), 15), round(math.sin(phi), 15), 0.0,
+        round(-math.sin(phi), 15), round(math.cos(phi), 15), 0.0,
+    ]
+
+    def apply(x, y):
+        return m[0] * x + m[1] * y + m[2], m[3] * x + m[4] * y + m[5]
+
+    m[2], m[5] = apply(-W / 2, -H / 2)
+    m[2] += W / 2
+    m[5] += H / 2
+    xs, ys = zip(*(apply(x, y) for x, y in ((0, 0), (W, 0), (W, H), (0, H))))
+    rw = math.ceil(max(xs)) - math.floor(min(xs))
+    rh = math.ceil(max(ys)) - math.floor(min(ys))
+    m[2], m[5] = apply(-(rw - W) / 2, -(rh - H) / 2)
+    return m, rw, rh
+
+
+def fixed16(v: float) -> int:
+    # Pillow ka NEAREST affine path 16.16 fixed point me chalta hai (Geometry.c FIX)
+    return math.floor(v * 65536 + 0.5)
+
+
+def diag_stamp(skey: tuple, piece: Image.Image, px: int, py: int, W: int, H: int,
+               angle: int, cache: bool = True):
+    """
+    Piece (frame me (px, py) pe) ka wo hissa jo W x H frame ko rotate(angle,
+    expand=True) karke beech se W x H crop karne pe aata: (image, x, y) ya None.
+
+    Sirf piece ka output bbox resample hota hai, full-frame rotate wale hi
+    matrix se. Pillow har output pixel ka source integer 16.16 steps se nikalta
+    hai, isliye crop offset + bbox origin + piece position start point me exact
+    jud jaate hain aur result full-frame rotate ke bit-for-bit barabar hai.
+    Cache key (angle, fixed-point start) = sub-pixel phase, frame size nahi.
+    """
+    m, rw, rh = rotate_matrix(W, H, angle)
+    left, top = max(0, (rw - W) // 2), max(0, (rh - H) // 2)
+    corners = ((0, 0), (rw, 0), (0, rh), (rw, rh))
+    if any(max(abs(m[0] * x + m[1] * y + m[2]), abs(m[3] * x + m[4] * y + m[5])) >= 32768
+           for x, y in corners):
+        # itna bada frame Pillow fixed point me nahi, float path me rotate karta hai;
+        # wo exact copy nahi ho sakta, isliye yahan purana full-frame tareeka
+        layer = Image.new("RGBA", (W, H), (0, 0, 0, 0))
+        layer.paste(piece, (px, py))
+        layer = layer.rotate(angle, expand=True).crop((left, top, left + W, top + H))
+        ink = layer.getchannel("A").getbbox()
+        return (layer.crop(ink), ink[0], ink[1]) if ink else None
+
+    # output bbox: piece ke corners forward map karke, rounding ke liye 2px margin
+    pw, ph = piece.size
+    pts = [rotate_point(px + x, py + y, W, H, angle) for x, y in ((0, 0), (pw, 0), (0, ph), (pw, ph))]
+    x0 = max(0, math.floor(min(p[0] for p in pts)) - 2)
+    y0 = max(0, math.floor(min(p[1] for p in pts)) - 2)
+    x1 = min(W, math.ceil(max(p[0] for p in pts)) + 2)
+    y1 = min(H, math.ceil(max(p[1] for p in pts)) + 2)
+    if x0 >= x1 or y0 >= y1:
+        return None
+
+    a0, a1, a3, a4 = (fixed16(v) for v in (m[0], m[1], m[3], m[4]))
+    sx = fixed16(m[2] + m[0] * 0.5 + m[1] * 0.5) + (x0 + left) * a0 + (y0 + top) * a1 - (px << 16)
+    sy = fixed16(m[5] + m[3] * 0.5 + m[4] * 0.5) + (x0 + left) * a3 + (y0 + top) * a4 - (py << 16)
+    key = ("diag", angle, sx, sy, x1 - x0, y1 - y0, *skey)
+    rot = STAMP_CACHE.get(key) if cache else None
+    if rot is None:
+        # float start aisa ki Pillow ka FIX() wapas thik sx / sy de
+        rot = piece.transform((x1 - x0, y1 - y0), Image.AFFINE, (
+            m[0], m[1], sx / 65536 - m[0] * 0.5 - m[1] * 0.5,
+            m[3], m[4], sy / 65536 - m[3] * 0.5 - m[4] * 0.5,
+        ))
+        if cache:
+            STAMP_CACHE.put(key, rot)
+    return rot, x0, y0
+
+
+def clip_box(stamp: Image.Image, x: int, y: int, W: int, H: int):
+    """Stamp coords me (left, top, right, bottom) jo W x H image ke andar aata hai, ya None."""
+    sw, sh = stamp.size
+    left, top = max(0, -x), max(0, -y)
+    right, bottom = min(sw, W - x), min(sh, H - y)
+    if left >= right or top >= bottom:
+        return None
+    return left, top, right, bottom
+
+
+def clip_stamp(stamp: Image.Image, x: int, y: int, W: int, H: int):
+    """Stamp ka jo hissa W x H image ke andar aata hai: (part, x, y) ya None."""
+    box = clip_box(stamp, x, y, W, H)
+    if not box:
+        return None
+    if box != (0, 0, stamp.width, stamp.height):
+        stamp = stamp.crop(box)
+    return stamp, x + box[0], y + box[1]
+
+
+# id(stamp) -> (stamp, premul, inv) NumPy blend planes
+PLANES_BYTES_PER_PX = 12  # premul + inv, dono uint16 x 3 channels
+PLANES_CACHE = LRUCache(
+    max_items=256,
+    max_bytes=int(STAMP_CACHE_MB * 1024 * 1024),
+    sizeof=lambda v: v[1].nbytes + v[2].nbytes,
+)
+
+
+def cached_planes(stamp: Image.Image):
+    cached = PLANES_CACHE.get(id(stamp))
+    # id reuse se bachne ke liye entry stamp ka reference bhi rakhti hai
+    if cached is not None and cached[0] is stamp:
+        return cached[1], cached[2]
+    return None
+
+
+def stamp_planes(stamp: Image.Image, cache: bool = True):
+    """
+    Stamp ke NumPy blend planes (dono uint16, stamp ke poore h x w x 3 shape me):
+        premul = src * a' + 128,  inv = 256 - a'
+    jahan a' = a + a // 128 alpha ko 0..256 pe le aata hai, taaki /256 sirf shift ho.
+    """
+    if cache:
+        cached = cached_planes(stamp)
+        if cached is not None:
+            return cached
+
+    rgba = np.asarray(stamp, dtype=np.uint16)
+    alpha = rgba[:, :, 3:]
+    alpha = alpha + (alpha >> 7)
+    premul = rgba[:, :, :3] * alpha + 128
+    # broadcast (h, w, 1) multiply bahut slow hai, isliye full shape
+    inv = np.ascontiguousarray(np.broadcast_to(256 - alpha, premul.shape))
+
+    if cache:
+        PLANES_CACHE.put(id(stamp), (stamp, premul, inv))
+    return premul, inv
+
+
+def blend_pillow(img: Image.Image, stamp: Image.Image, box: tuple, src: tuple = (0, 0),
+                 cache: bool = True):
+    w, h = box[2] - box[0], box[3] - box[1]
+    if src != (0, 0) or stamp.size != (w, h):
+        stamp = stamp.crop((src[0], src[1], src[0] + w, src[1] + h))
+    region = img.crop(box).convert("RGBA")
+    region.alpha_composite(stamp)
+    img.paste(region.convert(img.mode), box)
+
+
+def blend_numpy(img: Image.Image, stamp: Image.Image, box: tuple, src: tuple = (0, 0),
+                cache: bool = True):
+    """
+    dst = (dst * (256 - a') + src * a' + 128) >> 8, uint16 integer math me (float nahi).
+    a = 0 aur a = 255 pe exact, beech me Pillow alpha_composite se max +-1.
+    src: box ka top-left stamp ke andar kahan hai (clipped stamps ke liye).
+    Sirf cache hone layak stamps pe; baaki blocks blend_pillow pe jaate hain.
+    """
+    w, h = box[2] - box[0], box[3] - box[1]
+    planes = cached_planes(stamp) if cache else None
+    if planes is None:
+        nbytes = stamp.width * stamp.height * PLANES_BYTES_PER_PX
+        if not cache or nbytes > PLANES_CACHE.max_bytes // 2:
+            # planes reuse nahi honge (one-off / cache se bade): unhe banana khud blend se
+            # mehenga hai, isliye ye block Pillow se — wo bhi sirf block wala hissa crop karta hai
+            return blend_pillow(img, stamp, box, src, cache)
+        planes = stamp_planes(stamp)
+    premul, inv = planes
+    sx, sy = src
+    rows = slice(sy, sy + h)
+    cols = slice(sx, sx + w)
+
+    region = np.asarray(img.crop(box)).astype(np.uint16)
+    region *= inv[rows, cols]
+    region += premul[rows, cols]
+    region >>= 8
+    img.paste(Image.fromarray(region.astype(np.uint8), "RGB"), box)
+
+
+def blend_vips(img: Image.Image, stamp: Image.Image, box: tuple, src: tuple = (0, 0),
+               cache: bool = True):
+    """libvips composite2 "over"; region memory se vips me aur wapas."""
+    w, h = box[2] - box[0], box[3] - box[1]
+    if src != (0, 0) or stamp.size != (w, h):
+        stamp = stamp.crop((src[0], src[1], src[0] + w, src[1] + h))
+    base = pyvips.Image.new_from_memory(img.crop(box).tobytes(), w, h, 3, "uchar")
+    over = pyvips.Image.new_from_memory(stamp.tobytes(), w, h, 4, "uchar")
+    out = base.composite2(over, "over").extract_band(0, n=3)
+    if out.format != "uchar":
+        out = out.rint().cast("uchar")
+    img.paste(Image.frombytes("RGB", (w, h), out.write_to_memory()), box)
+
+# ------------------------------------------------------------
+# RENDER BACKENDS
+# ------------------------------------------------------------
+# Backend = blend(img, stamp, box, src, cache): stamp ka src se shuru hone wala
+# hissa RGB img ke box pe in-place composite. Stamps, layout aur encode sab
+# backends me same hain; sirf ye hot loop badalta hai.
+RENDER_BACKENDS = {"pillow": blend_pillow}
+if np is not None:
+    RENDER_BACKENDS["numpy"] = blend_numpy
+if pyvips is not None:
+    RENDER_BACKENDS["vips"] = blend_vips
+
+# process workers env se hi padhte hain (main process choose karke env set karta hai)
+BLEND_BACKEND = (
+    RENDER_BACKEND if RENDER_BACKEND in RENDER_BACKENDS
+    else "numpy" if np is not None else "pillow"
+)
+
+
+def benchmark_backends(repeat: int = 5) -> dict:
+    """
+    Har available backend ko synthetic 1280x960 photo pe do stamps (48 / 160 px)
+    ke saath time karta hai: name -> best ms. Pillow se +-2 se zyada farak ya
+    error ho to us backend ka result None.
+    """
+    size = (1280, 960)
+    noise = Image.effect_noise(size, 48)
+    base = Image.merge("RGB", (noise, Image.linear_gradient("L").resize(size), noise))
+    stamps = [
+        get_stamp(DEFAULT_WATERMARK, "sans_default", fs, (255, 255, 255), 220, "normal")[0]
+        for fs in (48, 160)
+    ]
+
+    def run(blend, img):
+        for i, st in enumerate(stamps):
+            blend(img, st, (i * 200, i * 200, i * 200 + st.width, i * 200 + st.height))
+
+    results = {}
+    ref = None
+    for name, blend in RENDER_BACKENDS.items():
+        try:
+            out = base.copy()
+            run(blend, out)
+            if ref is None:
+                ref = out  # pillow pehla hai, wahi reference
+            elif max(hi for _, hi in ImageChops.difference(ref, out).getextrema()) > 2:
+                logger.warning(f"Backend {name} ka output Pillow se match nahi karta, skip")
+                results[name] = None
+                continue
+            best = float("inf")
+            for _ in range(repeat):
+                img = base.copy()
+                t = time.perf_counter()
+                run(blend, img)
+                best = min(best, time.perf_counter() - t)
+            results[name] = best * 1000
+        except Exception as e:
+            logger.warning(f"Backend {name} self-benchmark fail: {e}")
+            results[name] = None
+    return results
+
+
+def choose_render_backend() -> str:
+    """RENDER_BACKEND env ya self-benchmark se backend fix; render pool banne se pehle call karo."""
+    global BLEND_BACKEND
+    if RENDER_BACKEND in RENDER_BACKENDS:
+        BLEND_BACKEND = RENDER_BACKEND
+        logger.info(f"Render backend: {BLEND_BACKEND} (RENDER_BACKEND env)")
+    else:
+        if RENDER_BACKEND != "auto":
+            logger.warning(f"RENDER_BACKEND={RENDER_BACKEND} available nahi, self-benchmark chala rahe")
+        times = benchmark_backends()
+        ok = {name: ms for name, ms in times.items() if ms is not None}
+        BLEND_BACKEND = min(ok, key=ok.get)
+        summary = ", ".join(
+            f"{name} {ms:.2f} ms" if ms is not None else f"{name} fail" for name, ms in times.items()
+        )
+        logger.info(f"Render backend: {BLEND_BACKEND} (self-benchmark: {summary})")
+    os.environ["RENDER_BACKEND"] = BLEND_BACKEND
+    return BLEND_BACKEND
+
+
+def blend_stamp(img: Image.Image, stamp: Image.Image, x: int, y: int, cache: bool = True):
+    """
+    Stamp ko img pe (x, y) par in-place blend karta hai. Sirf stamp ke
+    bounding box wala region touch hota hai, baaki pixels untouched.
+    RGB images pe BLEND_BACKEND ka blend, baaki modes (RGBA frames) pe Pillow.
+    cache=False one-off stamps ke liye (unke NumPy planes cache nahi hote).
+    RENDER_MEM_MB set ho to bada region horizontal strips me blend hota hai.
+    """
+    clip = clip_box(stamp, x, y, img.width, img.height)
+    if not clip:
+        return
+    left, top, right, bottom = clip
+
+    rows = bottom - top
+    if RENDER_MEM_MB:
+        strip_bytes = int(RENDER_MEM_MB * 1024 * 1024) // 8
+        rows = max(1, strip_bytes // ((right - left) * BLEND_BYTES_PER_PX))
+
+    blend = RENDER_BACKENDS[BLEND_BACKEND] if img.mode == "RGB" else blend_pillow
+    if rows >= bottom - top:
+        # clipped ho to bhi poora stamp + src offset (NumPy cached planes ka slice leta hai)
+        blend(img, stamp, (x + left, y + top, x + right, y + bottom), (left, top), cache)
+        return
+
+    # strip mode: har strip ka working set (aur uske planes) budget ke andar
+    for t in range(top, bottom, rows):
+        b = min(bottom, t + rows)
+        piece = stamp.crop((left, t, right, b))
+        blend(img, piece, (x + left, y + t, x + right, y + b), cache=False)
+
+
+def budget_dim(img: Image.Image, mem_budget: int) -> int:
+    """
+    Decode se pehle (sirf header se) check: frame budget ke aadhe me fit ho
+    (baaki aadha resize / strips / encoder ke liye). Na ho to JPEG ke liye
+    sabse kam DCT reduction (1/2, 1/4, 1/8) jisme fit ho uska longest side,
+    warna RenderTooLarge. 0 = koi limit nahi.
+    """
+    w, h = img.size
+    bands = max(3, len(img.getbands()))
+    frame_px = mem_budget // 2 // bands
+    if w * h <= frame_px:
+        return 0
+
+    if img.format == "JPEG":
+        for r in (2, 4, 8):
+            if math.ceil(w / r) * math.ceil(h / r) <= frame_px:
+                return max(math.ceil(w / r), math.ceil(h / r))
+
+    raise RenderTooLarge(f"{w}x{h} {img.format} image exceeds {mem_budget >> 20} MB render budget")
+
+
+def open_image(img_bytes: bytes, max_dim: int = 0, mem_budget: int = 0) -> Image.Image:
+    """
+    Image open karta hai; max_dim diya ho to longest side max_dim tak laata hai.
+    JPEG ke liye draft() decoder ko hi 1/2, 1/4, 1/8 scale pe decode karwata hai,
+    baaki formats pe reduce() integer box-downscale karta hai, phir final resize.
+    mem_budget (bytes) diya ho to decoded frame us budget me fit kiya jaata hai.
+    """
+    img = Image.open(BytesIO(img_bytes))
+    if mem_budget:
+        fit = budget_dim(img, mem_budget)
+        if fit:
+            max_dim = min(max_dim, fit) if max_dim else fit
+
+    if not max_dim or max(img.size) <= max_dim:
+        return img
+
+    scale = max_dim / max(img.size)
+    target = (max(1, round(img.width * scale)), max(1, round(img.height * scale)))
+
+    if img.format == "JPEG":
+        img.draft(img.mode, target)
+    else:
+        # resize ke liye 2x headroom chhod ke reduce, quality ke liye
+        factor = int(min(img.width / target[0], img.height / target[1]) / 2)
+        if factor >= 2:
+            img = img.reduce(factor)
+
+    if img.size != target:
+        img = img.resize(target, Image.Resampling.BICUBIC)
+    return img
+
+
+def watermark_plan(text: str, settings: dict) -> dict:
+    """
+    Settings ek baar parse karke render plan banata hai. Batch me ye plan
+    saari images ke liye reuse hota hai; "stamps" me font_size -> (stamp, bbox)
+    batch-local memo hai taaki har image pe cache lookup/measure na ho.
+    Logo mode me (aur logo saved ho to) text ki jagah "logo" = (uid, png) lagta hai.
+    """
+    logo = settings.get("logo")
+    use_logo = settings.get("mode") == "logo" and logo
+    return {
+        "text": text,
+        "logo": (logo["uid"], logo["png"]) if use_logo else None,
+        "size_factor": settings.get("size_factor", 1.0),
+        "color": auto_or_tuple(settings.get("color", (255, 255, 255))),
+        "alpha": int(settings.get("alpha", 220)),
+        "position": settings.get("position", "bottom_right"),
+        "font_key": settings.get("font_key", "sans_default"),
+        "transform": settings.get("transform", "normal"),
+        "effect": settings.get("effect", "shadow"),
+        "encoder": settings.get("encoder", ENCODER_PROFILE),
+        "stamps": {},
+    }
+
+
+def watermark_layers(W: int, H: int, plan: dict) -> list:
+    """
+    W x H frame pe lagne wale blends: [(stamp, x, y, cache), ...].
+    Pixels touch nahi hote, isliye decode se pehle bhi box nikal sakte hain.
+    """
+    text = plan["text"]
+    color = plan["color"]
+    alpha = plan["alpha"]
+    position = plan["position"]
+    font_key = plan["font_key"]
+    transform = plan["transform"]
+
+    font_size = font_size_for(W, plan["size_factor"])
+    if font_size not in plan["stamps"]:
+        if plan["logo"]:
+            uid, png = plan["logo"]
+            stamp, bbox = get_logo_stamp(uid, png, font_size, alpha)
+            skey = ("logo", uid, stamp.width, alpha)
+        else:
+            effect = plan["effect"]
+            stamp, bbox = get_stamp(text, font_key, font_size, color, alpha, transform, effect)
+            skey = (text, font_key, font_size, color, alpha, transform, effect)
+        plan["stamps"][font_size] = (stamp, bbox, skey)
+    stamp, bbox, skey = plan["stamps"][font_size]
+
+    tw = bbox[2] - bbox[0]
+    th = bbox[3] - bbox[1]
+    margin = 20
 
     if position == "top_left":
-        put(margin, margin, draw)
+        x, y = margin, margin
     elif position == "top_right":
-        put(W - tw - margin, margin, draw)
+        x, y = W - tw - margin, margin
     elif position == "bottom_left":
-        put(margin, H - th - margin, draw)
-    elif position == "bottom_right":
-        put(W - tw - margin, H - th - margin, draw)
-    elif position == "center":
-        put((W - tw) // 2, (H - th) // 2, draw)
-    elif position in ("diag_tl_br", "diag_bl_tr"):
-        temp = Image.new("RGBA", img.size, (0, 0, 0, 0))
-        d2 = ImageDraw.Draw(temp)
-        put((W - tw) // 2, (H - th) // 2, d2)
-
+        x, y = margin, H - th - margin
+    elif position == "center" or position in ("diag_tl_br", "diag_bl_tr"):
+        x, y = (W - tw) // 2, (H - th) // 2
+    else:
+        x, y = W - tw - margin, H - th - margin
+
+    # stamp ka top-left = text origin + bbox offset (logo ka bbox (0, 0, w, h) hai)
+    x += bbox[0]
+    y += bbox[1]
+
+    if position == "tile":
+        texture = tile_texture(skey, stamp, font_size, TILE_SPACING, TILE_ANGLE)
+        if texture is None:
+            # cell frame jitna bada: texture nahi, rotated stamp seedha brick pattern me
+            rot, cw, ch = tile_cell(skey, stamp, font_size, TILE_SPACING, TILE_ANGLE)
+            return [
+                (rot, col * cw + (cw // 2 if row % 2 else 0), row * ch, True)
+                for row in range(math.ceil(H / ch))
+                for col in range(-1, math.ceil(W / cw))
+            ]
+        return [
+            (texture, tx, ty, True)
+            for ty in range(0, H, texture.height)
+            for tx in range(0, W, texture.width)
+        ]
+
+    if position in ("diag_tl_br", "diag_bl_tr"):
+        # poora frame nahi, sirf stamp ka rotated bbox resample hota hai
         angle = -35 if position == "diag_tl_br" else 35
-        rot = temp.rotate(angle, expand=True)
-        rw, rh = rot.size
-        left = max(0, (rw - W) // 2)
-        top = max(0, (rh - H) // 2)
-        cropped = rot.crop((left, top, left + W, top + H))
-        txt_layer = Image.alpha_composite(txt_layer, cropped)
+        part = clip_stamp(stamp, x, y, W, H)
+        if not part:
+            return []
+        piece, x, y = part
+        # text frame se bahar tha to clipped piece cache nahi hota
+        layer = diag_stamp(skey, piece, x, y, W, H, angle, cache=piece is stamp)
+        if not layer:
+            return []
+        rot, x, y = layer
+        return [(rot, x, y, piece is stamp)]
+
+    return [(stamp, x, y, True)]
+
+
+def apply_watermark(img: Image.Image, plan: dict):
+    """Decoded RGB image pe plan ke hisaab se watermark (in-place)."""
+    if plan["color"] == "auto" or plan["position"] == "auto":
+        plan = resolve_auto(img, plan)
+    for stamp, x, y, cache in watermark_layers(img.width, img.height, plan):
+        blend_stamp(img, stamp, x, y, cache)
+
+
+# ------------------------------------------------------------
+# AUTO COLOUR / POSITION
+# ------------------------------------------------------------
+# "auto" colour/position image dekh ke decide hote hain. Analysis sirf ek
+# ~96px NEAREST thumbnail pe hota hai (sampled pixels hi padhe jaate hain),
+# full frame pe kabhi nahi — 12 MP photo pe bhi well under 1 ms.
+AUTO_DIM = 96
+AUTO_CORNERS = ("bottom_right", "bottom_left", "top_right", "top_left")  # tie pe pehla jeetega
+AUTO_BOX = (0.4, 0.2)  # corner region = frame width/height ka itna hissa
+AUTO_DARK_ABOVE = 140  # region ki mean luminance isse upar ho to kaala text
+
+
+def auto_or_tuple(color):
+    return color if color == "auto" else tuple(color)
+
+
+def analysis_thumb(img: Image.Image) -> Image.Image:
+    scale = AUTO_DIM / max(img.size)
+    size = (max(3, round(img.width * scale)), max(3, round(img.height * scale)))
+    thumb = img.resize(size, Image.Resampling.NEAREST)
+    return thumb if thumb.mode == "L" else thumb.convert("L")
+
+
+def auto_style(img: Image.Image, position: str, want_color: bool):
+    """
+    (color, position) return karta hai. position "auto" ho to sabse kam busy
+    corner (edge energy + luminance spread), want_color ho to us region ki
+    brightness ke hisaab se kaala ya safed.
+    """
+    thumb = analysis_thumb(img)
+    edges = thumb.filter(ImageFilter.FIND_EDGES)
+    # FIND_EDGES border pixels as-is copy karta hai, unhe chhod do
+    w, h = thumb.width - 2, thumb.height - 2
+    thumb = thumb.crop((1, 1, w + 1, h + 1))
+    edges = edges.crop((1, 1, w + 1, h + 1))
+
+    bw, bh = max(1, round(w * AUTO_BOX[0])), max(1, round(h * AUTO_BOX[1]))
+    boxes = {
+        "top_left": (0, 0, bw, bh),
+        "top_right": (w - bw, 0, w, bh),
+        "bottom_left": (0, h - bh, bw, h),
+        "bottom_right": (w - bw, h - bh, w, h),
+        "center": ((w - bw) // 2, (h - bh) // 2, (w + bw) // 2, (h + bh) // 2),
+    }
+
+    if position == "auto":
+        def busy(pos):
+            box = boxes[pos]
+            return (
+                ImageStat.Stat(edges.crop(box)).mean[0]
+                + ImageStat.Stat(thumb.crop(box)).stddev[0] / 2
+            )
+        position = min(AUTO_CORNERS, key=busy)
+
+    color = None
+    if want_color:
+        if position in boxes:
+            region = thumb.crop(boxes[position])
+        elif position == "tile":
+            region = thumb
+        else:
+            region = thumb.crop(boxes["center"])  # diagonals image center se guzarte hain
+        luma = ImageStat.Stat(region).mean[0]
+        color = (0, 0, 0) if luma > AUTO_DARK_ABOVE else (255, 255, 255)
+    return color, position
+
+
+def resolve_auto(img: Image.Image, plan: dict) -> dict:
+    """Plan ki copy jisme "auto" colour/position is image ke liye fix ho gaye."""
+    want_color = plan["color"] == "auto" and not plan["logo"]
+    color, position = auto_style(img, plan["position"], want_color)
+    resolved = {**plan, "position": position}
+    if want_color:
+        # batch me har image ka colour alag ho sakta hai, stamps memo per colour
+        resolved["color"] = color
+        resolved["stamps"] = plan.setdefault("auto_stamps", {}).setdefault(color, {})
+    return resolved
+
+
+# ------------------------------------------------------------
+# LOGO WATERMARK
+# ------------------------------------------------------------
+LOGO_MAX_DIM = 1024  # upload pe logo isse bada ho to yahin tak chhota karke store
+LOGO_SCALE = 4       # logo width = font size ka itna guna (text jitna hi visual weight)
+LOGO_BUCKET = 16     # scaled widths isi px step pe round hote hain, taaki cache hit ho
+
+# (uid,) -> decoded RGBA logo; ("scaled", uid, width, alpha) -> (stamp, bbox)
+LOGO_CACHE = LRUCache(
+    max_items=128,
+    max_bytes=int(STAMP_CACHE_MB * 1024 * 1024),
+    sizeof=_image_nbytes,
+)
+
+
+def normalize_logo(data: bytes) -> bytes:
+    """Upload hua logo RGBA PNG me, transparent border trim, max LOGO_MAX_DIM."""
+    img = Image.open(BytesIO(data))
+    img = img.convert("RGBA")
+    ink = img.getchannel("A").getbbox()
+    if not ink:
+        raise ValueError("logo poora transparent hai")
+    img = img.crop(ink)
+    img.thumbnail((LOGO_MAX_DIM, LOGO_MAX_DIM), Image.Resampling.LANCZOS)
+    out = BytesIO()
+    img.save(out, "PNG")
+    return out.getvalue()
+
+
+def get_logo_stamp(uid: str, png: bytes, font_size: int, alpha: int):
+    """
+    Logo ko text stamp jaisa (stamp, bbox) deta hai: size bucket tak scaled,
+    logo ki apni alpha * setting wali alpha. Full logo ek render me kabhi
+    resample nahi hota — har bucket ek hi baar banta hai.
+    """
+    width = max(LOGO_BUCKET, round(font_size * LOGO_SCALE / LOGO_BUCKET) * LOGO_BUCKET)
+    key = ("scaled", uid, width, alpha)
+    cached = LOGO_CACHE.get(key)
+    if cached is not None:
+        return cached
+
+    base = LOGO_CACHE.get((uid,))
+    if base is None:
+        base = Image.open(BytesIO(png)).convert("RGBA")
+        LOGO_CACHE.put((uid,), base)
+
+    height = max(1, round(base.height * width / base.width))
+    stamp = base.resize((width, height), Image.Resampling.LANCZOS)
+    a = max(0, min(alpha, 255))
+    if a < 255:
+        lut = [v * a // 255 for v in range(256)]
+        stamp.putalpha(stamp.getchannel("A").point(lut))
+
+    result = (stamp, (0, 0, width, height))
+    LOGO_CACHE.put(key, result)
+    return result
+
+
+# ------------------------------------------------------------
+# ANIMATION (GIF / animated WebP)
+# ------------------------------------------------------------
+ANIM_MAX_FRAMES = 1000
+# frames x frame area ki hard limit (RENDER_MEM_MB na ho tab bhi); saare frames
+# encode tak RGB/RGBA me rehte hain, isliye ~4 bytes/px — 60 MP ~ 240 MB
+ANIM_MAX_PIXELS = 60_000_000
+GIF_TRANSPARENT = 255  # output palette me transparency ke liye reserved index
+ANIM_PALETTE_SAMPLES = 4  # shared GIF palette itne frames se banti hai
+# animated WebP: Pillow ka default keyframe har 3-5 frame pe hota hai; 50 pe ~30% tez, file bhi chhoti
+ANIM_WEBP_PARAMS = {"quality": 85, "method": 0, "kmin": 49, "kmax": 50}
+
+
+def sniff_ext(data: bytes) -> str:
+    """Encoded bytes ka asli format (extension), header magic se."""
+    head = data[:16]
+    if head[:4] == b"GIF8":
+        return "gif"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "webp"
+    if head[:8] == b"\x89PNG\r\n\x1a\n":
+        return "png"
+    return "jpg"
+
+
+def shared_palette(frames: list, colors: int) -> Image.Image:
+    """Kuch frames ki sheet se ek adaptive palette — har frame isi pe map hota hai."""
+    step = max(1, len(frames) // ANIM_PALETTE_SAMPLES)
+    picks = frames[::step][:ANIM_PALETTE_SAMPLES]
+    w, h = picks[0].size
+    sheet = Image.new("RGB", (w * len(picks), h))
+    for i, fr in enumerate(picks):
+        sheet.paste(fr.convert("RGB"), (i * w, 0))
+    if sheet.width >= 512:
+        sheet = sheet.reduce(2)
+    return sheet.quantize(colors, method=Image.Quantize.MEDIANCUT)
+
+
+def render_animation(img: Image.Image, plan: dict) -> bytes:
+    """
+    GIF / animated WebP ke har frame pe watermark. Layers (aur auto style)
+    pehle frame pe ek hi baar resolve hote hain, blend sirf stamp region pe;
+    lagataar identical frames ek frame me merge (duration jud jaati hai).
+    GIF ek shared palette pe encode hota hai, per-frame quantize/optimize nahi.
+    """
+    n = getattr(img, "n_frames", 1)
+    if n > ANIM_MAX_FRAMES:
+        raise RenderTooLarge(f"{n} frames (limit {ANIM_MAX_FRAMES})")
+
+    fmt = img.format
+    W, H = img.size
+    size = (W, H)
+    if MAX_OUTPUT_DIM and max(W, H) > MAX_OUTPUT_DIM:
+        scale = MAX_OUTPUT_DIM / max(W, H)
+        size = (max(1, round(W * scale)), max(1, round(H * scale)))
+    mode = "RGBA" if img.mode in ("RGBA", "LA", "PA") or "transparency" in img.info else "RGB"
+    # saare frames encode tak `mode` me hi rakhe jaate hain (GIF bhi, quantize encode pe hota hai)
+    pixels = n * size[0] * size[1]
+    if pixels > ANIM_MAX_PIXELS:
+        raise RenderTooLarge(f"{n} frames of {size[0]}x{size[1]} > {ANIM_MAX_PIXELS / 1e6:g} MP")
+    if RENDER_MEM_MB and pixels * len(mode) > RENDER_MEM_MB * 2 ** 20:
+        raise RenderTooLarge(f"{n} frames of {size[0]}x{size[1]} > {RENDER_MEM_MB:g} MB")
+    loop = img.info.get("loop")
+
+    frames, durations = [], []
+    prev = None  # pichhle frame ke raw pixels (watermark se pehle)
+    layers = None
+    opaque = True  # WebP decoder hamesha RGBA deta hai, chahe alpha use na ho
+    for frame in ImageSequence.Iterator(img):
+        cur = frame.convert(mode)  # hamesha naya image, decoder ka frame reuse nahi hota
+        if cur.size != size:
+            cur = cur.resize(size, Image.Resampling.BICUBIC)
+        duration = frame.info.get("duration", 100)
+        raw = cur.tobytes()
+        if raw == prev:
+            durations[-1] += duration
+            continue
+        prev = raw
+
+        if layers is None:
+            if plan["color"] == "auto" or plan["position"] == "auto":
+                plan = resolve_auto(cur, plan)
+            layers = watermark_layers(size[0], size[1], plan)
+        for stamp, x, y, cache in layers:
+            blend_stamp(cur, stamp, x, y, cache)
+        frames.append(cur)
+        durations.append(duration)
+        if mode == "RGBA" and opaque:
+            opaque = cur.getchannel("A").getextrema()[0] == 255
+
+    if mode == "RGBA" and opaque:
+        # alpha plane encode karna WebP me kaafi mehenga hai, GIF me palette slot bachta hai
+        mode = "RGB"
+        frames = [fr.convert("RGB") for fr in frames]
+
+    t = time.perf_counter()
+    buf = BytesIO()
+    extra = {} if loop is None else {"loop": loop}
+    if fmt == "GIF":
+        transparent = mode == "RGBA"
+        palette = shared_palette(frames, 255 if transparent else 256)
+        if transparent:
+            # GIF me alpha 1-bit hai; frames poore hain isliye har frame pe background restore
+            cutout = [255 if a < 128 else 0 for a in range(256)]
+            extra.update(transparency=GIF_TRANSPARENT, disposal=2)
+        for i, fr in enumerate(frames):
+            pf = fr.convert("RGB").quantize(palette=palette, dither=Image.Dither.NONE)
+            if transparent:
+                pf.paste(GIF_TRANSPARENT, mask=fr.getchannel("A").point(cutout))
+            frames[i] = pf
+        # optimize=True har frame ka palette remap karta hai — shared palette pe uski zaroorat nahi
+        frames[0].save(
+            buf, "GIF", save_all=True, append_images=frames[1:], duration=durations,
+            optimize=False, **extra,
+        )
+        label = "GIF animation"
     else:
-        put(W - tw - margin, H - th - margin, draw)
+        frames[0].save(
+            buf, "WEBP", save_all=True, append_images=frames[1:], duration=durations,
+            **ANIM_WEBP_PARAMS, **extra,
+        )
+        label = "WebP animation"
+    data = buf.getvalue()
+    record_encode(label, (time.perf_counter() - t) * 1000, len(data))
+    return data
+
+
+def render_image(img_bytes: bytes, plan: dict) -> bytes:
+    if sniff_ext(img_bytes) in ("gif", "webp"):
+        anim = Image.open(BytesIO(img_bytes))
+        if getattr(anim, "is_animated", False):
+            return render_animation(anim, plan)
+
+    img = open_image(img_bytes, MAX_OUTPUT_DIM, int(RENDER_MEM_MB * 1024 * 1024))
+    # Telegram photos already RGB JPEG hote hain; baaki modes ek hi baar convert
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+    apply_watermark(img, plan)
+    return encode_image(img, plan["encoder"])
+
+
+def create_watermark(img_bytes: bytes, text: str, settings: dict) -> bytes:
+    return render_image(img_bytes, watermark_plan(text, settings))
+
+
+def create_watermarks(images, text: str, settings: dict):
+    """
+    Batch entry point (albums, ZIP uploads, channel backfills): settings, font
+    aur stamp poore batch ke liye ek hi baar resolve hote hain. Generator hai —
+    har output finish hote hi yield hota hai, input order me.
+    """
+    plan = watermark_plan(text, settings)
+    for img_bytes in images:
+        yield render_image(img_bytes, plan)
+
+
+JPEG_KEEP_FALLBACK = {"quality": 90}
+
+# encoder key -> {"count", "ms", "bytes"} (is worker me ab tak ke totals)
+ENCODER_STATS = {}
+
+
+def encoder_profile(encoder: str) -> tuple:
+    return (
+        ENCODER_PROFILES.get(encoder)
+        or ENCODER_PROFILES.get(ENCODER_PROFILE)
+        or ENCODER_PROFILES["jpeg_90"]
+    )
+
+
+def output_name(settings: dict, data: bytes = None) -> str:
+    """Upload filename; data diya ho to extension asli output se (animations apna format rakhti hain)."""
+    if data is not None:
+        return f"watermarked.{sniff_ext(data)}"
+    return f"watermarked.{encoder_profile(settings.get('encoder', ENCODER_PROFILE))[2]}"
+
+
+PHOTO_MAX_BYTES = 10 * 1024 * 1024  # sendPhoto limit; isse badi output document ki tarah
+
+
+def output_kind(data: bytes) -> str:
+    """
+    Telegram pe kaise bhejna hai: photo (JPEG) / animation (GIF) / document.
+    PNG / WebP photo ki tarah jaayein to Telegram unhe JPEG me recompress kar
+    deta hai (lossless khatam), isliye wo aur 10 MB se badi outputs document.
+    """
+    ext = sniff_ext(data)
+    if ext == "gif":
+        return "animation"
+    if ext != "jpg" or len(data) > PHOTO_MAX_BYTES:
+        return "document"
+    return "photo"
+
+
+def encode_image(img: Image.Image, encoder: str) -> bytes:
+    label, fmt, ext, params = encoder_profile(encoder)
+    if params.get("quality") == "keep" and img.format != "JPEG":
+        # source JPEG nahi tha (ya resize / convert hua): rakhne ko tables hi nahi
+        params = JPEG_KEEP_FALLBACK
 
-    watermarked = Image.alpha_composite(img, txt_layer).convert("RGB")
     out = BytesIO()
-    out.name = "watermarked.jpg"
-    watermarked.save(out, "JPEG", quality=90)
-    out.seek(0)
-    return out.read()
+    out.name = f"watermarked.{ext}"
+    t = time.perf_counter()
+    img.save(out, fmt, **params)
+    ms = (time.perf_counter() - t) * 1000
+    data = out.getvalue()  # BytesIO ka buffer hi mil jaata hai, copy nahi
+    record_encode(label, ms, len(data))
+    return data
+
+
+def record_encode(label: str, ms: float, size: int):
+    st = ENCODER_STATS.setdefault(label, {"count": 0, "ms": 0.0, "bytes": 0})
+    st["count"] += 1
+    st["ms"] += ms
+    st["bytes"] += size
+    logger.debug(f"Encoded {label}: {ms:.1f} ms, {size} bytes")
+
+
+def engine_stats() -> dict:
+    return {
+        "caches": {
+            "fonts": FONT_CACHE.stats(),
+            "stamps": STAMP_CACHE.stats(),
+            "glyph atlases": ATLAS_CACHE.stats(),
+            "logos": LOGO_CACHE.stats(),
+            "blend planes": PLANES_CACHE.stats(),
+        },
+        "encoders": ENCODER_STATS,
+        "backend": BLEND_BACKEND,
+    }
+
+# ------------------------------------------------------------
+# RENDER EXECUTOR
+# ------------------------------------------------------------
+# create_watermark CPU-heavy hai, isliye event loop pe nahi chalate.
+# Jobs pool me jaate hain; workers + queue se zyada jobs ho jaayein to
+# RenderBusy raise hota hai (backpressure), aur har job pe RENDER_TIMEOUT lagta hai.
+RENDER_POOL = None
+RENDER_INFLIGHT = 0
+
+
+class RenderBusy(Exception):
+    """Render queue full hai, caller ko baad me retry karwana hai."""
+
+
+def get_render_pool():
+    global RENDER_POOL, RENDER_MODE
+    if RENDER_POOL is not None or RENDER_MODE == "inline":
+        return RENDER_POOL
+
+    if RENDER_MODE == "process":
+        try:
+            # workers ko resolved font paths milte hain, dobara scan/probe nahi
+            RENDER_POOL = ProcessPoolExecutor(
+                max_workers=RENDER_WORKERS,
+                initializer=preload_fonts,
+                initargs=(dict(FONT_PATHS),),
+            )
+        except (OSError, NotImplementedError) as e:
+            logger.warning(f"Process pool unavailable, using threads: {e}")
+            RENDER_MODE = "thread"
+
+    if RENDER_POOL is None:
+        RENDER_POOL = ThreadPoolExecutor(
+            max_workers=RENDER_WORKERS,
+            thread_name_prefix="render",
+        )
+
+    logger.info(f"Render pool ready: {RENDER_MODE} x{RENDER_WORKERS}, queue {RENDER_QUEUE}")
+    return RENDER_POOL
+
+
+def shutdown_render_pool():
+    global RENDER_POOL
+    if RENDER_POOL is not None:
+        RENDER_POOL.shutdown(wait=False, cancel_futures=True)
+        RENDER_POOL = None
+
+
+def _render_done(_fut):
+    global RENDER_INFLIGHT
+    RENDER_INFLIGHT -= 1
+
+
+async def render_job(fn, *args, retry: bool = True):
+    """
+    fn(*args) ko render pool me chalata hai aur result await karta hai.
+    Worker beech me mar jaaye (OOM etc.) to naye pool pe ek baar retry.
+    Raises:
+        RenderBusy           -> queue full
+        asyncio.TimeoutError -> job RENDER_TIMEOUT se zyada chala
+        RenderTooLarge       -> retry pe bhi worker mar gaya
+    """
+    global RENDER_INFLIGHT
+    if RENDER_INFLIGHT >= RENDER_WORKERS + RENDER_QUEUE:
+        raise RenderBusy()
+
+    pool = get_render_pool()
+    if pool is None:
+        return fn(*args)
+    if isinstance(pool, ProcessPoolExecutor):
+        # originals cache ke mmap pickle nahi hote; process workers ko bytes jaate hain
+        args = tuple(bytes(a) if isinstance(a, mmap.mmap) else a for a in args)
+
+    loop = asyncio.get_running_loop()
+    try:
+        fut = pool.submit(fn, *args)
+    except BrokenProcessPool:
+        # koi worker mar gaya (OOM etc.) — naya pool bana ke ek baar retry
+        logger.warning("Render pool broken, restarting")
+        shutdown_render_pool()
+        fut = get_render_pool().submit(fn, *args)
+
+    # slot tabhi free hota hai jab worker sach me job chhod de (timeout pe nahi)
+    RENDER_INFLIGHT += 1
+    fut.add_done_callback(lambda f: loop.call_soon_threadsafe(_render_done, f))
+
+    try:
+        return await asyncio.wait_for(asyncio.wrap_future(fut), RENDER_TIMEOUT)
+    except BrokenProcessPool:
+        shutdown_render_pool()
+        if retry:
+            logger.warning("Render worker died mid-job, retrying once on a fresh pool")
+            return await render_job(fn, *args, retry=False)
+        raise RenderTooLarge("render worker died twice on this job (out of memory?)")
 
 # ------------------------------------------------------------
 # KEYBOARDS
@@ -369,11 +1899,13 @@ def settings_menu() -> InlineKeyboardMarkup:
         ],
         [
             InlineKeyboardButton("📍 Position", callback_data="pos_menu"),
+            InlineKeyboardButton("🗜 Output", callback_data="enc_menu"),
         ],
         [
             InlineKeyboardButton("🌫 Transparency", callback_data="trans_menu"),
             InlineKeyboardButton("📝 Text Style", callback_data="style_menu"),
         ],
+        [InlineKeyboardButton("🖼 Logo", callback_data="logo_menu")],
         [InlineKeyboardButton("⬅ Back", callback_data="back_main")],
     ])
 
@@ -423,6 +1955,51 @@ async def broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     await update.message.reply_text(f"✅ Broadcast sent to {sent} users.")
 
+# ------------------------------------------------------------
+# STATS (/stats)
+# ------------------------------------------------------------
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != OWNER_ID:
+        return await update.message.reply_text("❌ Owner Only Command.")
+
+    try:
+        data = await render_job(engine_stats)
+    except (RenderBusy, asyncio.TimeoutError):
+        return await update.message.reply_text("⏳ Render pool busy hai, baad me try karo.")
+
+    lines = [
+        f"📊 Engine cache stats ({RENDER_MODE}, {data['backend']} backend, ek worker ke counters):"
+    ]
+    for name, st in data["caches"].items():
+        total = st["hits"] + st["misses"]
+        rate = (100 * st["hits"] / total) if total else 0.0
+        lines.append(
+            f"• {name}: {st['items']} items, {st['hits']} hits / {st['misses']} misses ({rate:.1f}%)"
+        )
+    if data["encoders"]:
+        lines.append("\n🗜 Encoders (avg per image):")
+    for label, st in data["encoders"].items():
+        n = st["count"]
+        lines.append(
+            f"• {label}: {n} images, {st['ms'] / n:.1f} ms, {st['bytes'] / n / 1024:.0f} KB"
+        )
+    st = RESULT_CACHE.stats()
+    total = st["hits"] + st["misses"]
+    rate = (100 * st["hits"] / total) if total else 0.0
+    lines.append(
+        f"\n♻️ Result cache: {st['items']} items, {st['hits']} hits / {st['misses']} misses "
+        f"({rate:.1f}%){' + disk' if RESULT_CACHE_DIR else ''}"
+    )
+    if ORIGINALS is not None:
+        st = ORIGINALS.stats()
+        total = st["hits"] + st["misses"]
+        rate = (100 * st["hits"] / total) if total else 0.0
+        lines.append(
+            f"📥 Originals cache: {st['items']} files, {st['bytes'] >> 20} MB, "
+            f"{st['hits']} hits / {st['misses']} misses ({rate:.1f}%)"
+        )
+    await update.message.reply_text("\n".join(lines))
+
 # ------------------------------------------------------------
 # BUTTON CALLBACK
 # ------------------------------------------------------------
@@ -491,6 +2068,9 @@ async def callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 InlineKeyboardButton("🌸 गुलाबी", callback_data="c_pink"),
                 InlineKeyboardButton("⚙ ग्रे", callback_data="c_gray"),
             ],
+            [
+                InlineKeyboardButton("🪄 Auto", callback_data="c_auto"),
+            ],
             [InlineKeyboardButton("⬅ Back", callback_data="wm_menu")],
         ])
         return await query.message.reply_text("Watermark Colour:", reply_markup=kb)
@@ -505,6 +2085,7 @@ async def callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "c_blue": (0, 102, 255),
             "c_pink": (255, 105, 180),
             "c_gray": (128, 128, 128),
+            "c_auto": "auto",
         }
         settings["color"] = cmap[data]
         await update_settings(user_id, settings)
@@ -530,6 +2111,10 @@ async def callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             [
                 InlineKeyboardButton("Diag BL→TR", callback_data="p_d2"),
             ],
+            [
+                InlineKeyboardButton("Tile ▦", callback_data="p_tile"),
+                InlineKeyboardButton("🪄 Auto", callback_data="p_auto"),
+            ],
             [InlineKeyboardButton("⬅ Back", callback_data="wm_menu")],
         ])
         return await query.message.reply_text("Watermark Position:", reply_markup=kb)
@@ -543,6 +2128,8 @@ async def callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "p_c": "center",
             "p_d1": "diag_tl_br",
             "p_d2": "diag_bl_tr",
+            "p_tile": "tile",
+            "p_auto": "auto",
         }
         settings["position"] = pos[data]
         await update_settings(user_id, settings)
@@ -566,6 +2153,7 @@ async def callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 InlineKeyboardButton("Fonts", callback_data="font_menu"),
                 InlineKeyboardButton("Transform", callback_data="transform_menu"),
             ],
+            [InlineKeyboardButton("Effect", callback_data="effect_menu")],
             [InlineKeyboardButton("⬅ Back", callback_data="wm_menu")],
         ])
         return await query.message.reply_text("Text Style:", reply_markup=kb)
@@ -574,8 +2162,8 @@ async def callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if data == "font_menu":
         rows = []
         temp = []
-        for key, (label, paths) in FONT_STYLES.items():
-            temp.append(InlineKeyboardButton(label, callback_data=f"font_{key}"))
+        for key in font_choices():
+            temp.append(InlineKeyboardButton(font_label(key), callback_data=f"font_{key}"))
             if len(temp) == 2:
                 rows.append(temp)
                 temp = []
@@ -587,7 +2175,7 @@ async def callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     if data.startswith("font_"):
         font_key = data.replace("font_", "")
-        if font_key in FONT_STYLES:
+        if font_key in font_choices():
             settings["font_key"] = font_key
             await update_settings(user_id, settings)
             return await query.message.reply_text(
@@ -596,6 +2184,102 @@ async def callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         else:
             return await query.message.reply_text("❌ Font not found.")
 
+    # OUTPUT ENCODER MENU
+    if data == "enc_menu":
+        rows = []
+        temp = []
+        for key, (label, fmt, ext, params) in ENCODER_PROFILES.items():
+            temp.append(InlineKeyboardButton(label, callback_data=f"enc_{key}"))
+            if len(temp) == 2:
+                rows.append(temp)
+                temp = []
+        if temp:
+            rows.append(temp)
+        rows.append([InlineKeyboardButton("⬅ Back", callback_data="wm_menu")])
+        kb = InlineKeyboardMarkup(rows)
+        return await query.message.reply_text("Output Format:", reply_markup=kb)
+
+    if data.startswith("enc_"):
+        encoder = data.replace("enc_", "", 1)
+        if encoder in ENCODER_PROFILES:
+            settings["encoder"] = encoder
+            await update_settings(user_id, settings)
+            return await query.message.reply_text(
+                f"✅ Output set: {ENCODER_PROFILES[encoder][0]}"
+            )
+        else:
+            return await query.message.reply_text("❌ Format not found.")
+
+    # LOGO MENU
+    if data == "logo_menu":
+        has_logo = bool(settings.get("logo"))
+        mode = settings.get("mode", "text")
+        rows = [[InlineKeyboardButton("📤 Upload Logo", callback_data="logo_upload")]]
+        if has_logo:
+            rows.append([
+                InlineKeyboardButton(
+                    ("✅ " if mode == "text" else "") + "Text", callback_data="mode_text"
+                ),
+                InlineKeyboardButton(
+                    ("✅ " if mode == "logo" else "") + "Logo", callback_data="mode_logo"
+                ),
+            ])
+            rows.append([InlineKeyboardButton("🗑 Remove Logo", callback_data="logo_remove")])
+        rows.append([InlineKeyboardButton("⬅ Back", callback_data="wm_menu")])
+        kb = InlineKeyboardMarkup(rows)
+        return await query.message.reply_text(
+            "Logo Watermark:" if has_logo else "Abhi koi logo saved nahi hai.",
+            reply_markup=kb,
+        )
+
+    if data == "logo_upload":
+        USER_STATE[user_id] = "await_logo"
+        kb = InlineKeyboardMarkup([
+            [InlineKeyboardButton("⬅ Back", callback_data="logo_menu")]
+        ])
+        return await query.message.reply_text(
+            "Logo bhejo. Transparent PNG ho to *File/Document* ki tarah bhejo, "
+            "photo ki tarah bhejne pe transparency hat jaati hai.",
+            reply_markup=kb,
+            parse_mode="Markdown",
+        )
+
+    if data in ("mode_text", "mode_logo"):
+        if data == "mode_logo" and not settings.get("logo"):
+            return await query.message.reply_text("❌ Pehle logo upload karo.")
+        settings["mode"] = data.replace("mode_", "")
+        await update_settings(user_id, settings)
+        return await query.message.reply_text(
+            "✅ Ab logo lagega." if data == "mode_logo" else "✅ Ab text watermark lagega."
+        )
+
+    if data == "logo_remove":
+        settings["logo"] = None
+        settings["mode"] = "text"
+        await update_settings(user_id, settings)
+        return await query.message.reply_text("✅ Logo remove ho gaya, text watermark wapas on.")
+
+    # EFFECT MENU
+    if data == "effect_menu":
+        current = settings.get("effect", "shadow")
+        rows = [
+            [InlineKeyboardButton(
+                ("✅ " if key == current else "") + label, callback_data=f"fx_{key}"
+            )]
+            for key, label in TEXT_EFFECTS.items()
+        ]
+        rows.append([InlineKeyboardButton("⬅ Back", callback_data="style_menu")])
+        return await query.message.reply_text("Text Effect:", reply_markup=InlineKeyboardMarkup(rows))
+
+    if data.startswith("fx_"):
+        effect = data.replace("fx_", "", 1)
+        if effect in TEXT_EFFECTS:
+            settings["effect"] = effect
+            await update_settings(user_id, settings)
+            return await query.message.reply_text(f"✅ Effect set: {TEXT_EFFECTS[effect]}")
+        else:
+            return await query.message.reply_text("❌ Effect not found.")
+
     # TRANSFORM MENU
     if data == "transform_menu":
         kb = InlineKeyboardMarkup([
@@ -626,6 +2310,316 @@ async def callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update_settings(user_id, settings)
         return await query.message.reply_text("✅ Text transform updated.")
 
+# ------------------------------------------------------------
+# DOWNLOAD HELPER
+# ------------------------------------------------------------
+class DownloadSink:
+    """
+    download_to_memory() ke liye file-like out. BytesIO write() pe data copy
+    karta hai; ye sirf aaye hue bytes objects ko rakh leta hai.
+    """
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data) -> int:
+        self.chunks.append(data)
+        return len(data)
+
+    def getvalue(self) -> bytes:
+        if len(self.chunks) == 1 and isinstance(self.chunks[0], bytes):
+            return self.chunks[0]
+        return b"".join(self.chunks)
+
+
+def input_limit(media) -> str:
+    """
+    Download se pehle size check, Telegram ke metadata se (documents me sirf
+    file_size hota hai). Limit cross ho to reason, warna empty string.
+    """
+    w = getattr(media, "width", 0) or 0
+    h = getattr(media, "height", 0) or 0
+    if MAX_INPUT_PIXELS and w * h > MAX_INPUT_PIXELS:
+        return f"{w}x{h} > {MAX_INPUT_PIXELS / 1e6:g} MP"
+    size = media.file_size or 0
+    if MAX_INPUT_MB and size > MAX_INPUT_MB * 1024 * 1024:
+        return f"{size / 1048576:.1f} MB > {MAX_INPUT_MB:g} MB"
+    return ""
+
+
+def pick_photo(sizes: list, target: int = 0):
+    """
+    Telegram har photo ke kai PhotoSize bhejta hai. target (longest side) diya
+    ho to sabse chhota jo usse chhota na ho, warna sabse bada — dono limits ke
+    andar wale me se. Koi bhi limit me na ho to sabse chhota (caller reject karega).
+    """
+    sizes = sorted(sizes, key=lambda s: s.width * s.height)
+    allowed = [s for s in sizes if not input_limit(s)] or sizes[:1]
+    if target:
+        for size in allowed:
+            if max(size.width, size.height) >= target:
+                return size
+    return allowed[-1]
+
+
+async def download_media(media) -> bytes:
+    """Media ke raw bytes: originals cache hit pe mmap, warna Telegram se download."""
+    data = originals_get(media.file_unique_id)
+    if data is not None:
+        return data
+    file = await media.get_file()
+    sink = DownloadSink()
+    await file.download_to_memory(out=sink)
+    data = sink.getvalue()
+    originals_put(media.file_unique_id, data)
+    return data
+
+async def upload_output(send, data: bytes, settings: dict, caption: str, *args):
+    """
+    Render output bhejta hai: send(kind) -> reply_<kind> / send_<kind> method,
+    args (jaise chat_id) data se pehle jaate hain. Photo BadRequest (size /
+    dimensions) pe ek baar document ki tarah retry. Returns (message, kind),
+    upload fail ho to (None, kind).
+    """
+    kind = output_kind(data)
+    for attempt in ((kind, "document") if kind == "photo" else (kind,)):
+        try:
+            sent = await send(attempt)(
+                *args, data, filename=output_name(settings, data), caption=caption
+            )
+            return sent, attempt
+        except BadRequest as e:
+            logger.warning(f"Upload as {attempt} rejected: {e}")
+        except NetworkError as e:
+            logger.warning(f"Upload as {attempt} failed: {e}")
+            break
+    return None, kind
+
+# ------------------------------------------------------------
+# ORIGINALS CACHE
+# ------------------------------------------------------------
+# Downloaded originals ORIGINALS_CACHE_DIR me, naam = sha1(file_unique_id).
+# Index (name -> size) LRUCache hai jo byte cap cross hone pe sabse purani
+# file delete karta hai; startup pe disk se mtime order me banta hai aur hit
+# pe mtime touch hota hai, isliye restart ke baad bhi LRU order bana rehta hai.
+# Writes temp file + os.replace se atomic hain — aadhi likhi file kabhi hit nahi hoti.
+ORIGINALS = None  # LRUCache, pehli zaroorat pe
+ORIGINALS_TMP = ".tmp-"
+
+
+def _originals_evict(name: str, size: int):
+    try:
+        os.remove(os.path.join(ORIGINALS_CACHE_DIR, name))
+    except OSError:
+        pass
+
+
+def originals_index():
+    global ORIGINALS
+    if ORIGINALS is None and ORIGINALS_CACHE_DIR:
+        os.makedirs(ORIGINALS_CACHE_DIR, exist_ok=True)
+        ORIGINALS = LRUCache(
+            max_items=1 << 20,
+            max_bytes=int(ORIGINALS_CACHE_MB * 1024 * 1024),
+            sizeof=lambda size: size,
+            on_evict=_originals_evict,
+        )
+        files = []
+        for entry in os.scandir(ORIGINALS_CACHE_DIR):
+            if entry.name.startswith(ORIGINALS_TMP):
+                os.remove(entry.path)  # crash ke waqt adhoori write
+            elif entry.is_file():
+                st = entry.stat()
+                files.append((st.st_mtime, entry.name, st.st_size))
+        for _, name, size in sorted(files):
+            ORIGINALS.put(name, size)
+        logger.info(f"Originals cache: {len(files)} files, {ORIGINALS.bytes >> 20} MB")
+    return ORIGINALS
+
+
+def originals_name(uid: str) -> str:
+    return hashlib.sha1(uid.encode()).hexdigest()
+
+
+def originals_get(uid: str):
+    """Cached original ka read-only mmap (bytes jaisa hi use hota hai), ya None."""
+    index = originals_index()
+    if index is None:
+        return None
+    name = originals_name(uid)
+    if index.get(name) is None:
+        return None
+    path = os.path.join(ORIGINALS_CACHE_DIR, name)
+    try:
+        with open(path, "rb") as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        os.utime(path)
+    except (OSError, ValueError) as e:  # ValueError: khali file mmap nahi hoti
+        logger.warning(f"Originals cache read failed {name}: {e}")
+        return None
+    return data
+
+
+def originals_put(uid: str, data: bytes):
+    index = originals_index()
+    if index is None or not data or len(data) > index.max_bytes:
+        return
+    name = originals_name(uid)
+    tmp = None
+    try:
+        fd, tmp = tempfile.mkstemp(prefix=ORIGINALS_TMP, dir=ORIGINALS_CACHE_DIR)
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp, os.path.join(ORIGINALS_CACHE_DIR, name))
+    except OSError as e:
+        logger.warning(f"Originals cache write failed {name}: {e}")
+        if tmp and os.path.exists(tmp):
+            os.remove(tmp)
+        return
+    index.put(name, len(data))
+
+# ------------------------------------------------------------
+# RESULT CACHE
+# ------------------------------------------------------------
+# key -> (kind, file_id). Bot process me hi rehta hai (render workers me nahi);
+# hit pe na download, na decode, na upload — sirf file_id wapas bhej dete hain.
+RESULT_CACHE = LRUCache(RESULT_CACHE_SIZE)
+RESULT_DB = None  # disk tier (dbm), pehli zaroorat pe open
+RESULT_DB_ITEMS = 0  # disk tier me kitni entries (open pe gini jaati hain)
+
+# render output pe asar daalne wali settings; "logo" ki jagah sirf uska uid
+RESULT_KEYS = (
+    "size_factor", "color", "alpha", "position", "font_key", "transform", "effect", "encoder", "mode",
+)
+
+
+def result_key(uid: str, text: str, settings: dict) -> str:
+    canon = {k: settings.get(k, DEFAULT_SETTINGS[k]) for k in RESULT_KEYS}
+    logo = settings.get("logo")
+    if canon["mode"] == "logo" and logo:
+        canon["logo"] = logo["uid"]
+        text = ""  # logo mode me text render nahi hota
+    canon["max_dim"] = MAX_OUTPUT_DIM
+    canon["size_step"] = FONT_SIZE_STEP  # font size bucketing bhi output badalta hai
+    canon["mem_mb"] = RENDER_MEM_MB  # budget me fit karne ke liye decode chhota ho sakta hai
+    blob = json.dumps([uid, text, canon], sort_keys=True, separators=(",", ":"))
+    return hashlib.sha1(blob.encode()).hexdigest()
+
+
+def result_db():
+    global RESULT_DB
+    if RESULT_DB is None and RESULT_CACHE_DIR:
+        os.makedirs(RESULT_CACHE_DIR, exist_ok=True)
+        RESULT_DB = dbm.open(os.path.join(RESULT_CACHE_DIR, "results"), "c")
+        prune_result_db()
+        logger.info(f"Result cache disk tier: {RESULT_DB_ITEMS} entries")
+    return RESULT_DB
+
+
+def prune_result_db():
+    """
+    Disk tier ko RESULT_CACHE_DISK_ITEMS tak laata hai, sabse purani (last use
+    time) entries hata ke. Open pe chalta hai, aur running bot me tab jab
+    entries cap se 10% upar chali jaayein — full scan har put pe nahi.
+    """
+    global RESULT_DB_ITEMS
+    entries = []
+    for key in RESULT_DB.keys():
+        parts = RESULT_DB[key].split()
+        # purane format ("kind file_id") me time nahi tha: sabse pehle hatenge
+        entries.append((float(parts[2]) if len(parts) > 2 else 0.0, key))
+    RESULT_DB_ITEMS = len(entries)
+    if RESULT_DB_ITEMS <= RESULT_CACHE_DISK_ITEMS:
+        return
+    entries.sort()
+    for _, key in entries[:RESULT_DB_ITEMS - RESULT_CACHE_DISK_ITEMS]:
+        del RESULT_DB[key]
+    if hasattr(RESULT_DB, "reorganize"):  # gdbm deleted space tabhi chhodta hai
+        RESULT_DB.reorganize()
+    logger.info(f"Result cache disk tier: {RESULT_DB_ITEMS - RESULT_CACHE_DISK_ITEMS} old entries pruned")
+    RESULT_DB_ITEMS = RESULT_CACHE_DISK_ITEMS
+
+
+def close_result_db():
+    global RESULT_DB
+    if RESULT_DB is not None:
+        RESULT_DB.close()
+        RESULT_DB = None
+
+
+def result_db_set(key: str, kind: str, file_id: str):
+    """Disk entry "kind file_id time"; time last use ka hai, prune isi se hota hai."""
+    global RESULT_DB_ITEMS
+    if key not in RESULT_DB:
+        RESULT_DB_ITEMS += 1
+    RESULT_DB[key] = f"{kind} {file_id} {time.time():.0f}"
+    if RESULT_DB_ITEMS > RESULT_CACHE_DISK_ITEMS * 1.1:
+        prune_result_db()
+
+
+def result_get(key: str):
+    hit = RESULT_CACHE.get(key)
+    if result_db() is not None:
+        if hit is None:
+            raw = RESULT_DB.get(key)
+            if raw:
+                hit = tuple(raw.decode().split()[:2])
+                RESULT_CACHE.put(key, hit)
+        if hit is not None:
+            result_db_set(key, *hit)  # last use time refresh
+    return hit
+
+
+def result_put(key: str, message, kind: str):
+    """Bheje gaye message ka file_id yaad rakhta hai (kind: photo / animation / document)."""
+    media = message.photo[-1] if kind == "photo" else getattr(message, kind)
+    if media is None:
+        return
+    hit = (kind, media.file_id)
+    RESULT_CACHE.put(key, hit)
+    if result_db() is not None:
+        result_db_set(key, kind, media.file_id)
+
+# ------------------------------------------------------------
+# LOGO UPLOAD
+# ------------------------------------------------------------
+async def save_logo(update: Update, context: ContextTypes.DEFAULT_TYPE, media):
+    """await_logo state me aayi photo/document ko user ka logo bana deta hai."""
+    user = update.effective_user
+    data = await download_media(media)
+
+    try:
+        png = await render_job(normalize_logo, data)
+    except RenderBusy:
+        return await update.message.reply_text("⏳ Bot abhi busy hai, logo thodi der baad bhejo.")
+    except (
+        OSError, ValueError, Image.DecompressionBombError, asyncio.TimeoutError, RenderTooLarge,
+    ) as e:
+        logger.warning(f"Logo rejected for user {user.id}: {e}")
+        return await update.message.reply_text("❌ Ye logo read nahi ho paya, dusri image bhejo.")
+
+    settings = await get_settings(user.id)
+    settings["logo"] = {"file_id": media.file_id, "uid": media.file_unique_id, "png": png}
+    settings["mode"] = "logo"
+    await update_settings(user.id, settings)
+    USER_STATE.pop(user.id, None)
+    await update.message.reply_text("✅ Logo saved! Ab har photo pe ye logo lagega.")
+
+
+async def document_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # FORCE-SUB CHECK
+    if await ensure_subscribed(update, context):
+        return
+
+    # image documents abhi sirf logo upload ke liye
+    if USER_STATE.get(update.effective_user.id) == "await_logo":
+        document = update.message.document
+        too_big = input_limit(document)
+        if too_big:
+            logger.info(f"Logo rejected for user {update.effective_user.id}: {too_big}")
+            return await update.message.reply_text("❌ Logo file bahut badi hai, chhoti image bhejo.")
+        return await save_logo(update, context, document)
+
 # ------------------------------------------------------------
 # PHOTO HANDLER
 # ------------------------------------------------------------
@@ -636,11 +2630,59 @@ async def photo_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     user = update.effective_user
     chat_id = update.effective_chat.id
+    msg = update.message
+
+    # photo, ya GIF / WebP (animation ya file ki tarah bheja hua)
+    if msg.photo:
+        # sabse bada nahi, sabse chhota PhotoSize jo output (ya logo) ke liye kaafi ho
+        target = LOGO_MAX_DIM if USER_STATE.get(user.id) == "await_logo" else MAX_OUTPUT_DIM
+        media = pick_photo(msg.photo, target)
+    else:
+        media = msg.animation or msg.document
+    if msg.animation and msg.animation.mime_type != "image/gif":
+        # Telegram GIFs ko MP4 bana deta hai; video decode hum nahi karte
+        return await msg.reply_text("❌ MP4 animation support nahi hai. GIF ko File ki tarah bhejo.")
+
+    too_big = input_limit(media)
+    if too_big:
+        logger.info(f"Input rejected for user {user.id}: {too_big}")
+        return await msg.reply_text("❌ Photo bahut badi hai, chhoti photo bhejo.")
 
-    file = await update.message.photo[-1].get_file()
-    bio = BytesIO()
-    await file.download_to_memory(out=bio)
-    img_bytes = bio.getvalue()
+    if USER_STATE.get(user.id) == "await_logo":
+        return await save_logo(update, context, media)
+
+    # Logo mode: text ka wait nahi, seedha render
+    settings = await get_settings(user.id)
+    if settings.get("mode") == "logo" and settings.get("logo"):
+        caption = f"✅ Watermark added.\n{style_label(settings)}"
+        key = result_key(media.file_unique_id, "", settings)
+        hit = result_get(key)
+        if hit:
+            kind, file_id = hit
+            return await getattr(msg, f"reply_{kind}")(file_id, caption=caption)
+
+        img_bytes = await download_media(media)
+        try:
+            wm_bytes = await render_job(create_watermark, img_bytes, "", settings)
+        except RenderBusy:
+            return await msg.reply_text("⏳ Bot abhi busy hai, photo thodi der baad bhejo.")
+        except asyncio.TimeoutError:
+            logger.warning(f"Render timeout for user {user.id}")
+            return await msg.reply_text(
+                "❌ Photo process nahi ho payi (timeout). Chhoti photo bhej ke try karo."
+            )
+        except RenderTooLarge as e:
+            logger.warning(f"Render too large for user {user.id}: {e}")
+            return await msg.reply_text("❌ Photo bahut badi hai, chhoti photo bhejo.")
+        except (OSError, ValueError, Image.DecompressionBombError) as e:
+            logger.warning(f"Unreadable image from user {user.id}: {e}")
+            return await msg.reply_text(UNREADABLE_IMAGE)
+        sent, kind = await upload_output(
+            lambda k: getattr(msg, f"reply_{k}"), wm_bytes, settings, caption
+        )
+        if sent is None:
+            return await msg.reply_text(UPLOAD_FAILED)
+        return result_put(key, sent, kind)
 
     # Cancel old
     old = PENDING.get(user.id)
@@ -649,14 +2691,16 @@ async def photo_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     task = context.application.create_task(timeout_task(context.application, user.id))
 
+    # download text aane ke baad hi — result cache hit ho to kabhi nahi
     PENDING[user.id] = {
-        "img": img_bytes,
+        "media": media,
+        "img": None,
         "task": task,
         "chat_id": chat_id,
     }
 
-    await update.message.reply_text(
-        f"📷 Photo received!\n"
+    await msg.reply_text(
+        f"{'📷 Photo' if msg.photo else '🎞 Animation'} received!\n"
         f"{TIMEOUT} sec ke andar watermark text bhejo.\n"
         f"Warana default `{DEFAULT_WATERMARK}` use hoga."
     )
@@ -692,23 +2736,46 @@ async def text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     # Cancel timeout
-    pending = PENDING[user.id]
+    pending = PENDING.pop(user.id)
     if pending["task"]:
         pending["task"].cancel()
 
-    img_bytes = pending["img"]
     settings = await get_settings(user.id)
-
-    wm_bytes = create_watermark(img_bytes, text, settings)
-    out = BytesIO(wm_bytes)
-    out.name = "watermarked.jpg"
-
-    del PENDING[user.id]
-
-    await update.message.reply_photo(
-        out,
-        caption=f"✅ Watermark added.\nFont: {font_label(settings['font_key'])}",
+    caption = f"✅ Watermark added.\n{style_label(settings)}"
+    key = result_key(pending["media"].file_unique_id, text, settings)
+    hit = result_get(key)
+    if hit:
+        kind, file_id = hit
+        return await getattr(update.message, f"reply_{kind}")(file_id, caption=caption)
+
+    img_bytes = pending["img"] or await download_media(pending["media"])
+    try:
+        wm_bytes = await render_job(create_watermark, img_bytes, text, settings)
+    except RenderBusy:
+        # photo wapas rakh do (downloaded bytes ke saath), user thodi der baad text bhej sakta hai
+        PENDING.setdefault(user.id, {**pending, "img": img_bytes})
+        return await update.message.reply_text(
+            "⏳ Bot abhi busy hai, thodi der baad watermark text dubara bhejo."
+        )
+    except asyncio.TimeoutError:
+        logger.warning(f"Render timeout for user {user.id}")
+        return await update.message.reply_text(
+            "❌ Photo process nahi ho payi (timeout). Chhoti photo bhej ke try karo."
+        )
+    except RenderTooLarge as e:
+        logger.warning(f"Render too large for user {user.id}: {e}")
+        return await update.message.reply_text("❌ Photo bahut badi hai, chhoti photo bhejo.")
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        logger.warning(f"Unreadable image from user {user.id}: {e}")
+        return await update.message.reply_text(UNREADABLE_IMAGE)
+
+    # bytes seedha upload me jaate hain (InputFile inhe copy nahi karta)
+    sent, kind = await upload_output(
+        lambda k: getattr(update.message, f"reply_{k}"), wm_bytes, settings, caption
     )
+    if sent is None:
+        return await update.message.reply_text(UPLOAD_FAILED)
+    result_put(key, sent, kind)
 
 # ------------------------------------------------------------
 # TIMEOUT TASK
@@ -719,35 +2786,76 @@ async def timeout_task(app: Application, user_id: int):
     except asyncio.CancelledError:
         return
 
-    pending = PENDING.get(user_id)
+    pending = PENDING.pop(user_id, None)
     if not pending:
         return
 
-    img_bytes = pending["img"]
     chat_id = pending["chat_id"]
     settings = await get_settings(user_id)
-
-    wm_bytes = create_watermark(img_bytes, DEFAULT_WATERMARK, settings)
-    out = BytesIO(wm_bytes)
-    out.name = "watermarked.jpg"
-
-    del PENDING[user_id]
-
-    await app.bot.send_photo(
-        chat_id,
-        out,
-        caption=f"⌛ Time up! Default watermark added.\nFont: {font_label(settings['font_key'])}",
+    caption = f"⌛ Time up! Default watermark added.\n{style_label(settings)}"
+    key = result_key(pending["media"].file_unique_id, DEFAULT_WATERMARK, settings)
+    hit = result_get(key)
+    if hit:
+        kind, file_id = hit
+        return await getattr(app.bot, f"send_{kind}")(chat_id, file_id, caption=caption)
+
+    img_bytes = pending["img"] or await download_media(pending["media"])
+    try:
+        wm_bytes = await render_job(create_watermark, img_bytes, DEFAULT_WATERMARK, settings)
+    except RenderBusy:
+        PENDING.setdefault(user_id, {**pending, "img": img_bytes, "task": None})
+        return await app.bot.send_message(
+            chat_id,
+            "⏳ Bot abhi busy hai, watermark text bhej do — photo abhi bhi saved hai.",
+        )
+    except asyncio.TimeoutError:
+        logger.warning(f"Render timeout for user {user_id}")
+        return await app.bot.send_message(
+            chat_id,
+            "❌ Photo process nahi ho payi (timeout). Chhoti photo bhej ke try karo.",
+        )
+    except RenderTooLarge as e:
+        logger.warning(f"Render too large for user {user_id}: {e}")
+        return await app.bot.send_message(chat_id, "❌ Photo bahut badi hai, chhoti photo bhejo.")
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        logger.warning(f"Unreadable image from user {user_id}: {e}")
+        return await app.bot.send_message(chat_id, UNREADABLE_IMAGE)
+
+    sent, kind = await upload_output(
+        lambda k: getattr(app.bot, f"send_{k}"), wm_bytes, settings, caption, chat_id
     )
+    if sent is None:
+        return await app.bot.send_message(chat_id, UPLOAD_FAILED)
+    result_put(key, sent, kind)
 
 # ------------------------------------------------------------
 # MAIN
 # ------------------------------------------------------------
+async def on_shutdown(app: Application):
+    shutdown_render_pool()
+    close_result_db()
+
+
 def main():
-    app = Application.builder().token(BOT_TOKEN).build()
+    if "--bench-backends" in sys.argv[1:]:
+        # sirf self-benchmark: python bot.py --bench-backends
+        for name, ms in benchmark_backends().items():
+            print(f"{name:>8}: {'fail' if ms is None else f'{ms:.2f} ms'}")
+        return
+
+    build_font_registry()
+    choose_render_backend()
+    app = Application.builder().token(BOT_TOKEN).post_shutdown(on_shutdown).build()
 
     app.add_handler(CommandHandler("start", start))
+    app.add_handler(CommandHandler("stats", stats))
     app.add_handler(CallbackQueryHandler(callback))
-    app.add_handler(MessageHandler(filters.PHOTO, photo_handler))
+    app.add_handler(MessageHandler(
+        filters.PHOTO | filters.ANIMATION | filters.Document.GIF
+        | filters.Document.MimeType("image/webp"),
+        photo_handler,
+    ))
+    app.add_handler(MessageHandler(filters.Document.IMAGE, document_handler))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, text_handler))
 
     logger.info("Bot started...")